@@ -1,36 +1,147 @@
+import json
+import logging
+import math
 import os.path
+from datetime import datetime, timedelta
 
-import requests.exceptions
-from flask import render_template, request, flash, redirect, url_for, abort, jsonify
-from langchain_core.messages import HumanMessage
-from sqlalchemy import select
+import click
+from flask import (render_template, request, flash, redirect, url_for, abort, jsonify, make_response, Response,
+                   stream_with_context, send_file)
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 
-from models import db, create_app, User, Character, ChatHistory, create_chatbot
+from models import (db, create_app, User, Character, ChatHistory, StorySummary, StoryOpener, RemoteImage, JobRecord,
+                    count_tokens)
+# Loads langchain only once a chatbot, prompt or message is created
+from models.chat_bot import (create_chatbot, to_message, to_messages, generate_opening, MAX_CONTEXT_TOKENS,
+                             SUMMARY_THRESHOLD_TOKENS, SUMMARY_CHUNK_TOKENS, OPENING_REQUEST)
+from services import (JobQueue, REGISTRY, init_metrics, configure_logging, ImageStore, InvalidImageError,
+                      ImageFetcher, RemoteImageError, ProcessLocal, TurnScheduler,
+                      AdmissionController, AdmissionRejected)
+from services.logging_setup import redact_headers, redact_body
+from services.metrics import CONTEXT_BUILD_DURATION
 
 BASE_TOTAL = 48 # Total points of attributes before distribution 6 Skills * 8 Base Points
 MAX_POINTS = 10 # Total of points to distribute
 
+logger = logging.getLogger(__name__)
+
 # Call create app from db.py
 app = create_app()
 
+# Log through a background queue
+configure_logging(debug=os.getenv('FLASK_DEBUG', '').lower() in ('1', 'true'))
+
 # Define Upload Folder
 UPLOAD_FOLDER = 'static/character_images'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Create chatbot
-chatbot_app = create_chatbot()
+# Uploaded portraits are stored content-addressed beside the database
+app.config['IMAGE_STORE_PATH'] = os.getenv('IMAGE_STORE_PATH', os.path.join(app.root_path, 'data', 'images'))
+image_store = ImageStore(app.config['IMAGE_STORE_PATH'])
+
+# Largest request that creates a character, so an upload is never read into memory unbounded
+app.config['MAX_UPLOAD_BYTES'] = int(os.getenv('MAX_UPLOAD_BYTES', 5 * 1024 * 1024))
+
+# Images never change under their digest, let browsers keep them for a year
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Remote images are mirrored in the background into the image store
+# Only public hosts are fetched, REMOTE_IMAGE_ALLOW_PRIVATE=1 also allows local ones for development
+image_fetcher = ImageFetcher(image_store, max_bytes=int(os.getenv('REMOTE_IMAGE_MAX_BYTES', 5 * 1024 * 1024)),
+                             allow_private=os.getenv('REMOTE_IMAGE_ALLOW_PRIVATE', '').lower() in ('1', 'true'))
+
+# Mirrors of remote images are revalidated with their ETag after this time
+REMOTE_IMAGE_REVALIDATE_AFTER = timedelta(seconds=int(os.getenv('REMOTE_IMAGE_REVALIDATE_AFTER', 24 * 60 * 60)))
+
+# Create chatbot on first use in every worker process, with its own checkpoint connection
+chatbot = ProcessLocal(create_chatbot)
+
+
+def get_chatbot():
+    """
+    The chatbot of this worker process, None if it cannot be created
+    """
+    try:
+        return chatbot.get()
+    except Exception:
+        logger.exception("Creating the chatbot failed")
+        return None
+
+# Create the job queue for LLM turns
+app.config['JOB_WORKERS'] = int(os.getenv('JOB_WORKERS', 4))
+app.config['MAX_CONCURRENT_LLM_CALLS'] = int(os.getenv('MAX_CONCURRENT_LLM_CALLS', 4))
+
+job_queue = JobQueue(app,
+                     workers=app.config['JOB_WORKERS'],
+                     max_llm_calls=app.config['MAX_CONCURRENT_LLM_CALLS'])
+
+# Turns of one conversation run in order, different conversations in parallel
+turn_scheduler = TurnScheduler()
+
+# Admission control in front of the model, 0 switches a limit off
+app.config['ADMISSION_USER_RATE'] = float(os.getenv('ADMISSION_USER_RATE', 0.5))
+app.config['ADMISSION_USER_BURST'] = float(os.getenv('ADMISSION_USER_BURST', 5))
+app.config['ADMISSION_GLOBAL_RATE'] = float(os.getenv('ADMISSION_GLOBAL_RATE', 10))
+app.config['ADMISSION_GLOBAL_BURST'] = float(os.getenv('ADMISSION_GLOBAL_BURST', 20))
+app.config['ADMISSION_MAX_IN_FLIGHT'] = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 32))
+
+admission = AdmissionController(user_rate=app.config['ADMISSION_USER_RATE'],
+                                user_burst=app.config['ADMISSION_USER_BURST'],
+                                global_rate=app.config['ADMISSION_GLOBAL_RATE'],
+                                global_burst=app.config['ADMISSION_GLOBAL_BURST'],
+                                max_in_flight=app.config['ADMISSION_MAX_IN_FLIGHT'])
+
+# Number of ready-made openings kept per language
+app.config['OPENER_POOL_SIZE'] = int(os.getenv('OPENER_POOL_SIZE', 5))
+
+# Fill the pool once a process serves its first request, so the first stories after
+# a deploy do not wait for the model. Not at import, CLI commands import the app too
+_openers_scheduled = False
+
+
+@app.before_request
+def _schedule_opener_fill():
+    global _openers_scheduled
+    if not _openers_scheduled and app.config['OPENER_POOL_SIZE'] > 0:
+        _openers_scheduled = True
+        # TODO make language selectable
+        job_queue.submit(_refill_openers, "English", key=("openers", "English"))
+
 
 #Add CORS
 CORS(app)
 
+# Record route, query and model timings for /metrics
+with app.app_context():
+    init_metrics(app, db.engine)
+
 # Import and create objects of the data managers
-from data import CharacterManager, UserManager, ChatManager
+from data import (CharacterManager, UserManager, ChatManager, OpenerManager, ResolutionCache, ImageManager,
+                  GroupCommitWriter, TranscriptManager, TranscriptError, JobManager, ChatNotFoundError,
+                  message_to_dict)
+
+# Shared cache of usernames and character names to their ids
+resolution_cache = ResolutionCache(max_size=int(os.getenv('RESOLUTION_CACHE_SIZE', 1024)),
+                                   ttl=int(os.getenv('RESOLUTION_CACHE_TTL', 300)))
 
-character_manager = CharacterManager(db, Character, User)
-user_manager = UserManager(db, User, Character)
-chat_manager = ChatManager(db, ChatHistory)
+character_manager = CharacterManager(db, Character, User, resolution_cache)
+user_manager = UserManager(db, User, Character, resolution_cache)
+# Group chat writes of concurrent turns into one commit, 0 writes every turn on its own
+app.config['CHAT_WRITE_BEHIND_MS'] = int(os.getenv('CHAT_WRITE_BEHIND_MS', 0))
+
+group_commit = None
+if app.config['CHAT_WRITE_BEHIND_MS'] > 0:
+    group_commit = GroupCommitWriter(app, db, ChatHistory, window=app.config['CHAT_WRITE_BEHIND_MS'] / 1000)
+
+chat_manager = ChatManager(db, ChatHistory, StorySummary, group_commit)
+opener_manager = OpenerManager(db, StoryOpener)
+image_manager = ImageManager(db, RemoteImage, Character)
+transcript_manager = TranscriptManager(db, User, Character, ChatHistory, StorySummary)
+
+# Job states are kept in the database, so every worker process can answer a poll
+job_manager = JobManager(db, JobRecord)
+job_queue.store = job_manager
 
 # TODO Refractor routes to their own py
 @app.route('/', methods=['GET'])
@@ -78,10 +189,12 @@ def characters_of_user(username):
     When you click a username on homepage, the app retrieves
     all characters of a user and displays them
     """
-    user = db.session.query(User).filter_by(username=username).one_or_none()
-    characters = user_manager.get_characters(user.user_id)
+    user = user_manager.get_user_with_characters(username)
+
+    if not user:
+        abort(404)
 
-    return render_template("characters.html", characters=characters, user=user)
+    return render_template("characters.html", characters=user.created_chars, user=user)
 
 
 @app.route('/users/<string:username>/characters', methods=['POST'])
@@ -89,6 +202,9 @@ def add_character(username):
     """
     Adds a new character to user list of characters
     """
+    # Answers 413 before the form is parsed
+    request.max_content_length = app.config['MAX_UPLOAD_BYTES']
+
     user = db.session.query(User).filter_by(username=username).one_or_none()
     char_name = request.form.get('char_name').strip()
 
@@ -119,32 +235,29 @@ def add_character(username):
         return redirect(url_for('characters_of_user', username=username))
 
     PLACEHOLDER_PATH = url_for('static', filename='character_images/Portrait_Placeholder.png', _external=True)
-    secure_char_name = secure_filename(char_name)
 
     uploaded_img = request.files.get('char_img')
     image_url = request.form.get('char_url')
 
     image_path_or_url = None
+    image_digest = None
+    image_data = None
 
     if uploaded_img and uploaded_img.filename:
-        file_extension = os.path.splitext(uploaded_img.filename)[1]
-        unique_filename = f"{secure_char_name}{file_extension}"
-
-        upload_dir = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
-        file_path = os.path.join(upload_dir, unique_filename)
+        image_data = uploaded_img.read()
+        try:
+            image_digest = image_store.add(image_data)
+        except InvalidImageError as e:
+            flash(f"Error: {e}", "error")
+            return redirect(url_for('characters_of_user', username=username))
 
-        uploaded_img.save(file_path)
-        image_path_or_url = url_for('static', filename=f'character_images/{unique_filename}', _external=True)
+        image_path_or_url = url_for('serve_image', digest=image_digest, variant='original', _external=True)
 
     elif image_url:
-        try:
-            r = requests.head(image_url, timeout=5)
-            if 'image' in r.headers.get('Content-Type', ''):
-                image_path_or_url = image_url
-            else:
-                return "Invalid image URL or unsupported type", 400
-        except requests.exceptions.RequestException:
-            return "Could not reach provided image URL", 400
+        # The image is checked and mirrored in the background once the character exists
+        if not image_url.startswith(('http://', 'https://')):
+            return "Invalid image URL or unsupported type", 400
+        image_path_or_url = image_url
 
     if not image_path_or_url:
         image_path_or_url = PLACEHOLDER_PATH
@@ -153,22 +266,36 @@ def add_character(username):
     personality = request.form.get('personality')
     backstory = request.form.get('backstory')
 
-    character = (character_manager.create_character
-                 (char_name=char_name,
-                  user_id=user.user_id,
-                  char_image=image_path_or_url,
-
-                  appearance=appearance,
-                  personality=personality,
-                  backstory=backstory,
-
-                  strength=strength,
-                  dexterity=dexterity,
-                  constitution=constitution,
-                  intelligence=intelligence,
-                  wisdom=wisdom,
-                  charisma=charisma
-                  ))
+    with image_store.lock():
+        # A character deleted since the upload was stored can have released the same image
+        if image_digest and image_store.path(image_digest, 'thumb') is None:
+            image_store.add(image_data)
+
+        character = (character_manager.create_character
+                     (char_name=char_name,
+                      user_id=user.user_id,
+                      char_image=image_path_or_url,
+
+                      appearance=appearance,
+                      personality=personality,
+                      backstory=backstory,
+
+                      strength=strength,
+                      dexterity=dexterity,
+                      constitution=constitution,
+                      intelligence=intelligence,
+                      wisdom=wisdom,
+                      charisma=charisma,
+                      image_digest=image_digest
+                      ))
+
+    # Do not keep an upload of a character that could not be created
+    if image_digest and character.startswith("Error"):
+        _release_image(image_digest)
+
+    if image_path_or_url == image_url and not character.startswith("Error"):
+        new_char = character_manager.get_character(user.user_id, char_name)
+        job_queue.submit(_mirror_remote_image, new_char.char_id, image_url, PLACEHOLDER_PATH)
 
     flash(message=character)
     return redirect(url_for('characters_of_user', username=user.username))
@@ -180,7 +307,11 @@ def char(username, char_name):
     Show Char to update or delete it
     """
     user = db.session.query(User).filter_by(username=username).one_or_none()
-    character = db.session.query(Character).filter_by(char_name=char_name).one_or_none()
+
+    if not user:
+        abort(404)
+
+    character = character_manager.get_character(user.user_id, char_name)
 
     return render_template("char_display.html", character=character, user=user)
 
@@ -191,7 +322,7 @@ def update_character(username, char_name):
     Change details of the character
     """
     user = db.session.query(User).filter_by(username=username).one_or_none()
-    character_to_update= user.created_chars.filter(Character.char_name == char_name).one_or_none()
+    character_to_update = character_manager.get_character(user.user_id, char_name) if user else None
 
     if not user or not character_to_update:
         abort(404)
@@ -199,9 +330,7 @@ def update_character(username, char_name):
     if request.method == 'POST':
         name = request.form.get('char_name').strip()
 
-        # bring over to datamanager?
-        character_to_update.char_name = name
-        db.session.commit()
+        character_manager.update_character(character_to_update.char_id, name)
 
         #Redirect back to list of characters of a user
         return redirect(url_for('characters_of_user', username=user.username))
@@ -217,26 +346,17 @@ def delete_character(username, char_name):
     Delete a character from the users list
     """
     user = db.session.query(User).filter_by(username=username).one_or_none()
-    char_to_delete = user.created_chars.filter(Character.char_name == char_name).one_or_none()
+    char_to_delete = character_manager.get_character(user.user_id, char_name)
+    image_digest = char_to_delete.image_digest
     image_path = char_to_delete.char_image
 
-    print(image_path)
-
-    static_url_prefix = url_for('static', filename='character_images/', _external=True)
-
-    if image_path and image_path.startswith(static_url_prefix):
-        filename_to_delete = image_path.replace(static_url_prefix, '', 1)
-
-        filename_to_delete = secure_filename(filename_to_delete)
-
-        upload_dir = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'])
-        file_path = os.path.join(upload_dir, filename_to_delete)
-
-        if os.path.exists(file_path):
-            os.remove(file_path)
-
     character_manager.delete_character(char_to_delete.char_id)
 
+    if image_digest:
+        _release_image(image_digest)
+    else:
+        _delete_legacy_upload(image_path)
+
     return redirect(url_for('characters_of_user', username=user.username))
 
 
@@ -245,11 +365,7 @@ def chat_using_streamlit(username, char_name):
     """
     Display chat with streamlit
     """
-
-    user = db.session.query(User).filter_by(username=username).one_or_none()
-    character = db.session.query(Character).filter_by(char_name=char_name).one_or_none()
-
-    if not user or not character:
+    if not character_manager.resolve(username, char_name):
         return "User or Character not found", 404
 
     return render_template('chat.html', username=username, char_name=char_name)
@@ -258,148 +374,622 @@ def chat_using_streamlit(username, char_name):
 @app.route('/users/<string:username>/characters/<string:char_name>/chat', methods=['POST'])
 def send_chat_message(username, char_name):
     """
-    Streamlit Endpoint for saving the messages
+    Streamlit Endpoint for saving the messages.
+    Answers with the saved message of the user and the reply of the AI,
+    so the client does not have to fetch the history again
     """
-    if chatbot_app is None:
-        return jsonify({"error": "Chatbot is unavailable."}), 503
+    chatbot_app, user_id, char_id, message_content, admitted = _admit_chat_message(username, char_name)
 
-    user = db.session.query(User).filter_by(username=username).one_or_none()
-    character = db.session.query(Character).filter_by(char_name=char_name).one_or_none()
+    if _wants_async():
+        job_id = job_queue.submit(_run_admitted, admitted, _run_chat_turn, user_id, char_id, message_content,
+                                  order_key=int(f"{user_id}{char_id}"))
+        return _accepted(job_id)
 
-    if not user or not character:
+    try:
+        with admitted:
+            messages = _run_chat_turn(user_id, char_id, message_content)
+    except ChatNotFoundError:
         return jsonify({"error": "User or Character not found"}), 404
 
-    user_id = user.user_id
-    char_id = character.char_id
+    return jsonify({"success": True, "messages": messages}), 200
+
+
+@app.route('/users/<string:username>/characters/<string:char_name>/chat/stream', methods=['POST'])
+def stream_chat_message(username, char_name):
+    """
+    Streamlit Endpoint for a message, answers with the AI reply as Server-Sent-Events.
+    Every token is sent as soon as the model produces it, the exchange is saved
+    into the ChatHistory once the stream ends.
+    """
+    chatbot_app, user_id, char_id, message_content, admitted = _admit_chat_message(username, char_name)
 
     # Create thread id
     thread_id = int(f"{user_id}{char_id}")
     config = {"configurable": {"thread_id": thread_id}}
 
-    print("\n--- Incoming POST Request Debug ---")
+    def generate():
+        ai_response_content = ""
+
+        # Turns of the same conversation run one after the other, the context is selected in turn
+        with turn_scheduler.turn(thread_id):
+            chat_input, summarized_through = _chat_input(user_id, char_id, message_content)
+
+            try:
+                with job_queue.llm_slot():
+                    for event in chatbot_app.stream(
+                        input=chat_input,
+                        config=config,
+                        stream_mode="custom",
+                        recursion_limit=5
+                    ):
+                        if event.get("reset"):
+                            # The model router failed over, the next model starts the reply over
+                            ai_response_content = ""
+                            yield _sse_event({"reset": True}, event="reset")
+                        elif event.get("token"):
+                            ai_response_content += event["token"]
+                            yield _sse_event({"token": event["token"]})
+
+            except Exception as e:
+                logger.exception("Streaming the answer for %s/%s failed", username, char_name)
+                yield _sse_event({"error": f"Chatbot failed to answer: {e}"}, event="error")
+                return
+
+            # Save the exchange once the reply is complete
+            try:
+                messages = chat_manager.save_messages(user_id, char_id, [
+                    ('character', message_content, chat_input["messages"][0].additional_kwargs["token_count"]),
+                    ('ai', ai_response_content)
+                ])
+            except ChatNotFoundError:
+                character_manager.forget(char_id)
+                yield _sse_event({"error": "User or Character not found"}, event="error")
+                return
+
+            if summarized_through is not None:
+                _save_summary(user_id, char_id, chatbot_app.get_state(config).values, summarized_through)
+
+        yield _sse_event({"success": True, "messages": [_message_json(message) for message in messages]},
+                         event="done")
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Also released if the client goes away before the stream started
+    response.call_on_close(admitted.release)
+    return response
 
-    # 1. Check Headers (Is Content-Type present?)
-    print("Headers:", dict(request.headers))
 
-    # 2. Check Raw Data (Is the body empty?)
-    try:
-        raw_data = request.data.decode('utf-8')
-        print("Raw Request Body:", raw_data)
-        request.data = raw_data.encode('utf-8')  # Reset data stream for get_json()
-    except Exception as e:
-        print(f"Error reading raw data: {e}")
+def _admit_chat_message(username, char_name):
+    """
+    Checks of a new message shared by the chat endpoints: the chatbot, the names, the JSON body
+    and the admission control. Aborts with the JSON error of the first check that fails.
+    Returns (chatbot_app, user_id, char_id, message_content, admitted)
+    """
+    chatbot_app = get_chatbot()
+    if chatbot_app is None:
+        _abort_json("Chatbot is unavailable.", 503)
+
+    # Cached, a character deleted on another worker is noticed when the turn is saved
+    ids = character_manager.resolve(username, char_name)
 
-    print("-----------------------------------")
+    if not ids:
+        _abort_json("User or Character not found", 404)
+
+    user_id, char_id = ids
+
+    # Only copy headers and body for the log if debug records are written at all
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Chat request headers=%s body=%s",
+                     redact_headers(request.headers), redact_body(request.get_data(cache=True)))
 
-   #try:
     data = request.get_json(silent=True)
-    # except Exception as e:
-    #     return jsonify({"error": f"Invalid JSON Format in request body:{e}"}), 400
-    if data is None:
-        return jsonify({"error": f"Invalid JSON Format in request body."}), 400
+    if not isinstance(data, dict):
+        _abort_json("Invalid JSON Format in request body.", 400)
     message_content = data.get('message')
 
-    print(f"DEBUG send_chat_message(): message_content = {repr(message_content)}")
-
     if not message_content or not message_content.strip():
-        return jsonify({"error": "Message could not be found."}), 400
-
-    # Save the message from user
-    new_message = ChatHistory(
-        message=message_content,
-        role='character',
-        user_id=user_id,
-        char_id=char_id
-    )
-    db.session.add(new_message)
+        _abort_json("Message could not be found.", 400)
 
-    # Invoke AI response
-    input_message = [HumanMessage(content=message_content)]
+    try:
+        admitted = admission.admit(user_id)
+    except AdmissionRejected as e:
+        abort(make_response(_too_many_requests(e)))
 
-    # TODO make language selectable
-    response_state = chatbot_app.invoke(
-        input={"messages": input_message, "language": "English"},
-        config=config,
-        recursion_limit=5
-    )
+    return chatbot_app, user_id, char_id, message_content, admitted
 
-    ai_response_content = response_state["messages"][-1].content
 
-    # Save AI response
-    ai_message = ChatHistory(
-        message=ai_response_content,
-        role='ai',
-        user_id=user_id,
-        char_id=char_id
-    )
-    db.session.add(ai_message)
+def _abort_json(error, status):
+    """
+    End the request with a JSON error, without the HTML error pages
+    """
+    abort(make_response(jsonify({"error": error}), status))
 
-    # Commit the exchange
-    db.session.commit()
 
-    return jsonify({"success": True}), 200
+def _sse_event(payload, event=None):
+    """
+    Format a payload as a single Server-Sent-Event
+    """
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload)}\n\n"
 
 
 @app.route('/users/<string:username>/characters/<string:char_name>/history', methods=['GET'])
 def get_chat_history(username, char_name):
     """
     Create an endpoint with a json for streamlit to get the chats history
+    Supports cursors to only load a part of the history:
+        ?after=<chat_id> for messages newer than chat_id
+        ?before=<chat_id>&limit=N for the N messages older than chat_id
+    Answers with 304 if the client already has the newest version (If-None-Match)
     """
-    user = db.session.query(User).filter_by(username=username).one_or_none()
-    character = db.session.query(Character).filter_by(char_name=char_name).one_or_none()
+    ids = character_manager.resolve(username, char_name)
 
-    if not user or not character:
+    if not ids:
         return {"error": "User or Character not found"}, 404
 
-    user_id = user.user_id
-    char_id = character.char_id
-    thread_id = int(f"{user_id}{char_id}")
-    config = {"configurable": {"thread_id":thread_id}}
+    user_id, char_id = ids
+
+    after = request.args.get('after', type=int)
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', type=int)
+
+    count, last_chat_id = chat_manager.get_history_state(user_id, char_id)
+
+    if not count:
+        # Writes the opening, so a character deleted on another worker must not be served from the cache
+        if character_manager.resolve(username, char_name, verify=True) != ids:
+            return {"error": "User or Character not found"}, 404
+
+        try:
+            admitted = admission.admit(user_id)
+        except AdmissionRejected as e:
+            return _too_many_requests(e)
+
+        if _wants_async():
+            job_id = job_queue.submit(_run_admitted, admitted, _run_opening, user_id, char_id,
+                                      key=("opening", user_id, char_id), order_key=int(f"{user_id}{char_id}"),
+                                      on_duplicate=admitted.release)
+            return _accepted(job_id)
+
+        with admitted:
+            _run_opening(user_id, char_id)
+        count, last_chat_id = chat_manager.get_history_state(user_id, char_id)
+
+    # The history only changes with new messages, so its size and newest id identify it
+    etag = f"{user_id}-{char_id}-{count}-{last_chat_id}-{request.query_string.decode()}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
 
     # Load chat history
-    chat_history = db.session.execute(
-        select(ChatHistory).where(
-            (ChatHistory.user_id == user_id),
-            (ChatHistory.char_id == char_id)
-        ).order_by(ChatHistory.created.asc())
-    ).scalars().all()
-
-    if not chat_history:
-        initial_message = [HumanMessage(content="Start the story.")]
-
-        response_state = chatbot_app.invoke(
-            input={"messages": initial_message, "language": "English"},
-            config=config,
-            recursion_limit=5
-        )
+    chat_history = chat_manager.get_history(user_id, char_id, after=after, before=before, limit=limit)
+
+    # Convert to JSON
+    history_json = [_message_json(message_to_dict(msg)) for msg in chat_history]
+
+    # return history
+    response = jsonify(history_json)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/images/<string:digest>/<string:variant>', methods=['GET'])
+def serve_image(digest, variant):
+    """
+    Serve a variant (original, webp or thumb) of a stored portrait with immutable cache headers
+    """
+    path = image_store.path(digest, variant)
+
+    if path is None:
+        abort(404)
+
+    response = send_file(path, max_age=IMAGE_MAX_AGE, etag=digest + variant, conditional=True)
+    response.headers['Cache-Control'] = f"public, max-age={IMAGE_MAX_AGE}, immutable"
+    return response
+
+
+@app.template_global()
+def portrait_url(character, variant='thumb'):
+    """
+    Url of a variant of the portrait of a character, the stored url for remote or placeholder images
+    """
+    if character.image_digest:
+        return url_for('serve_image', digest=character.image_digest, variant=variant)
+    return character.char_image
+
+
+def _mirror_remote_image(char_id, url, placeholder_url):
+    """
+    Fetch a remote image into the image store and let the character use the local copy.
+    A known mirror is reused, after REMOTE_IMAGE_REVALIDATE_AFTER it is revalidated with its ETag.
+    If the url is no reachable image, the character gets the placeholder.
+    """
+    remote_image = image_manager.get_remote_image(url)
+    image_digest = remote_image.image_digest if remote_image else None
+    etag = remote_image.etag if remote_image else None
+
+    # The local copy could have been deleted with its last character
+    if image_digest and image_store.path(image_digest, 'thumb') is None:
+        image_digest, etag = None, None
+
+    is_fresh = image_digest and datetime.now() - remote_image.fetched < REMOTE_IMAGE_REVALIDATE_AFTER
+
+    # A second try if a deleted character released the image between the fetch and its use
+    for _ in range(2):
+        if not is_fresh:
+            try:
+                fetched = image_fetcher.fetch(url, etag=etag)
+            except RemoteImageError as e:
+                logger.warning("Mirroring %s failed: %s", url, e)
+                image_manager.set_character_image(char_id, char_image=placeholder_url)
+                return
+
+            if fetched is not None:
+                image_digest, etag = fetched
+            image_manager.save_remote_image(url, image_digest, etag)
+
+        with image_store.lock():
+            if image_digest and image_store.path(image_digest, 'thumb') is not None:
+                message = image_manager.set_character_image(char_id, image_digest=image_digest)
+                break
+
+        is_fresh, etag = False, None
+    else:
+        image_manager.set_character_image(char_id, char_image=placeholder_url)
+        return
+
+    # The character was deleted in the meantime
+    if message.startswith("Error"):
+        _release_image(image_digest)
+
+
+def _release_image(image_digest):
+    """
+    Delete an image from the store once no character uses it anymore
+    """
+    with image_store.lock():
+        if character_manager.count_image_references(image_digest) == 0:
+            image_store.delete(image_digest)
+
+
+def _delete_legacy_upload(image_path):
+    """
+    Delete an upload of a character that was saved into UPLOAD_FOLDER before the image store
+    """
+    static_url_prefix = url_for('static', filename='character_images/', _external=True)
+
+    if not image_path or not image_path.startswith(static_url_prefix):
+        return
+
+    filename_to_delete = secure_filename(image_path.replace(static_url_prefix, '', 1))
+
+    # The placeholder is shared by all characters without a portrait
+    if filename_to_delete == 'Portrait_Placeholder.png':
+        return
+
+    file_path = os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], filename_to_delete)
+
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+@app.route('/users/<string:username>/export', methods=['GET'])
+def export_user_transcripts(username):
+    """
+    Stream the campaigns of all characters of a user as NDJSON
+    """
+    user_id = user_manager.resolve_user(username)
+
+    if user_id is None:
+        return {"error": "User not found"}, 404
+
+    return _ndjson_response(transcript_manager.export_transcripts(user_id), username)
+
+
+@app.route('/users/<string:username>/characters/<string:char_name>/export', methods=['GET'])
+def export_character_transcript(username, char_name):
+    """
+    Stream the campaign of one character as NDJSON
+    """
+    ids = character_manager.resolve(username, char_name)
+
+    if not ids:
+        return {"error": "User or Character not found"}, 404
+
+    user_id, char_id = ids
+
+    return _ndjson_response(transcript_manager.export_transcripts(user_id, char_id), f"{username}-{char_name}")
+
+
+@app.route('/users/<string:username>/import', methods=['POST'])
+def import_transcripts(username):
+    """
+    Import an NDJSON export into the campaigns of a user.
+    The body is read line by line, so it is never held in memory as a whole.
+    """
+    user_id = user_manager.resolve_user(username, verify=True)
+
+    if user_id is None:
+        return {"error": "User not found"}, 404
+
+    try:
+        result = _import_transcripts(user_id, request.stream)
+    except TranscriptError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"success": True,
+                    "characters": [char_name for _, char_name in result["characters"]],
+                    "messages": result["messages"]}), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Route, database and model metrics in the Prometheus text format
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id):
+    """
+    Status endpoint to poll a queued chat turn or opening
+    """
+    job = job_queue.get(job_id)
+
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    return jsonify(job), 200
+
+
+def _wants_async():
+    """
+    Clients ask for a queued answer with ?async=1 or the header 'Prefer: respond-async'
+    """
+    return (request.args.get('async', '').lower() in ('1', 'true')
+            or 'respond-async' in request.headers.get('Prefer', ''))
+
+
+def _accepted(job_id):
+    """
+    Answer with 202 and the job id the client can poll
+    """
+    status_url = url_for('get_job', job_id=job_id)
+    return jsonify({"job_id": job_id, "status_url": status_url}), 202, {"Location": status_url}
+
+
+def _too_many_requests(rejection):
+    """
+    Shed load at once with 429 and the seconds after which a retry can succeed
+    """
+    retry_after = max(1, math.ceil(rejection.retry_after))
+    return jsonify({"error": str(rejection)}), 429, {"Retry-After": str(retry_after)}
+
+
+def _run_admitted(admitted, func, *args):
+    """
+    Run a queued job of an admitted request, the admission ends with the job
+    """
+    with admitted:
+        return func(*args)
+
+
+@CONTEXT_BUILD_DURATION.time()
+def _chat_input(user_id, char_id, message_content):
+    """
+    Build the graph input for a new message: the message itself, the running summary
+    and the newest stored messages that fit into the context window together with them.
+    Old turns between the summary and the window are handed over to be summarized
+    once they reach SUMMARY_THRESHOLD_TOKENS, at most SUMMARY_CHUNK_TOKENS of the oldest per turn.
+    Returns the input and the chat_id the summary covers after this turn (None if unchanged)
+    """
+    input_message = to_message('character', message_content, count_tokens(message_content))
+
+    story_summary = chat_manager.get_summary(user_id, char_id)
+    summary = story_summary.summary if story_summary else ""
+    summarized_through = story_summary.summarized_through if story_summary else 0
+    summary_tokens = story_summary.token_count if story_summary else 0
+
+    budget = MAX_CONTEXT_TOKENS - input_message.additional_kwargs["token_count"] - summary_tokens
+    window_rows = chat_manager.get_context_window(user_id, char_id, budget, after=summarized_through)
+
+    overflow = []
+    new_summarized_through = None
+    if window_rows:
+        window_start = window_rows[0].chat_id
+        if chat_manager.count_tokens_between(user_id, char_id, summarized_through, window_start) \
+                >= SUMMARY_THRESHOLD_TOKENS:
+            overflow = chat_manager.get_summary_chunk(user_id, char_id, summarized_through, window_start,
+                                                      SUMMARY_CHUNK_TOKENS)
+            new_summarized_through = overflow[-1].chat_id
+
+    window = to_messages(window_rows)
+
+    # TODO make language selectable
+    chat_input = {
+        "messages": [input_message],
+        "language": "English",
+        "window": window + [input_message],
+        "summary": summary,
+        "overflow": to_messages(overflow),
+        "summarized": False,
+    }
+    return chat_input, new_summarized_through
+
+
+def _save_summary(user_id, char_id, state, summarized_through):
+    """
+    Save the summary the graph extended in this turn, unless folding the old turns failed
+    """
+    summary = state.get("summary")
+    if summarized_through is None or not state.get("summarized") or not summary:
+        return
+
+    chat_manager.save_summary(user_id, char_id, summary, summarized_through, count_tokens(summary))
+
+
+def _run_chat_turn(user_id, char_id, message_content):
+    """
+    Invoke the AI with a message of the user and save the exchange into the ChatHistory.
+    Returns the saved messages
+    """
+    thread_id = int(f"{user_id}{char_id}")
+    config = {"configurable": {"thread_id": thread_id}}
+
+    # Turns of the same conversation run one after the other
+    with turn_scheduler.turn(thread_id):
+        # Select the context before the new message is added to the session
+        chat_input, summarized_through = _chat_input(user_id, char_id, message_content)
+
+        # Invoke AI response
+        with job_queue.llm_slot():
+            response_state = chatbot.get().invoke(
+                input=chat_input,
+                config=config,
+                recursion_limit=5
+            )
 
         ai_response_content = response_state["messages"][-1].content
 
-        # Save AI message
-        ai_message = ChatHistory(
-            message=ai_response_content,
-            role='ai',
-            user_id=user_id,
-            char_id=char_id
+        # Save the message from user and the AI response in one transaction
+        try:
+            # The message of the user was counted for the context already
+            messages = chat_manager.save_messages(user_id, char_id, [
+                ('character', message_content, chat_input["messages"][0].additional_kwargs["token_count"]),
+                ('ai', ai_response_content)
+            ])
+        except ChatNotFoundError:
+            # Deleted by another worker, its cached ids are stale
+            character_manager.forget(char_id)
+            raise
+
+        _save_summary(user_id, char_id, response_state, summarized_through)
+
+    return [_message_json(message) for message in messages]
+
+
+def _message_json(message):
+    """
+    A saved message as the chat endpoints return it
+    """
+    return {
+        "chat_id": message["chat_id"],
+        "role": message["role"],
+        "messages": message["message"],
+        "created": message["created"].isoformat() if message["created"] else None,
+    }
+
+
+def _run_opening(user_id, char_id, language="English"):
+    """
+    Start the story with an opening from the pool and save it into the ChatHistory.
+    Only if the pool is empty the AI writes the opening now.
+    The pool is refilled in the background.
+    """
+    thread_id = int(f"{user_id}{char_id}")
+    config = {"configurable": {"thread_id": thread_id}}
+
+    with turn_scheduler.turn(thread_id):
+        # Another request may have started the story while this one waited
+        if chat_manager.get_history_state(user_id, char_id)[0]:
+            return
+
+        opening = opener_manager.claim_opener(language)
+
+        if opening is None:
+            with job_queue.llm_slot():
+                opening = generate_opening(language)
+
+        # Save AI message together with the claim of the opening. Not through the write-behind
+        # writer, its INSERT would wait for the write lock the uncommitted claim holds
+        chat_manager.save_messages(user_id, char_id, [('ai', opening)], write_behind=False)
+
+        # Let the conversation start with the opening
+        chatbot.get().update_state(
+            config,
+            {"messages": [to_message('character', OPENING_REQUEST), to_message('ai', opening)]},
+            as_node="model"
         )
-        db.session.add(ai_message)
-        db.session.commit()
 
-        # Reload history chat
-        chat_history = db.session.execute(
-            select(ChatHistory).where(
-                (ChatHistory.user_id == user_id),
-                (ChatHistory.char_id == char_id)
-            ).order_by(ChatHistory.created.asc())
-        ).scalars().all()
+    job_queue.submit(_refill_openers, language, key=("openers", language))
 
-    # Convert to JSON
-    history_json = [
-        {"role": msg.role, "messages": msg.message}
-        for msg in chat_history
-    ]
-    # return history
-    return jsonify(history_json)
+
+def _refill_openers(language):
+    """
+    Fill the pool of openings up to OPENER_POOL_SIZE.
+    Every opening counts against the in-flight limit of the admission control,
+    if it is reached the pool is filled by the next refill instead
+    """
+    while opener_manager.count_openers(language) < app.config['OPENER_POOL_SIZE']:
+        try:
+            admitted = admission.admit_background()
+        except AdmissionRejected:
+            logger.info("Postponed filling the %s openings, too many model calls in flight", language)
+            return
+
+        with admitted, job_queue.llm_slot():
+            opening = generate_opening(language)
+        opener_manager.add_opener(opening, language)
+
+
+def _ndjson_response(lines, filename):
+    """
+    Stream lines of NDJSON as a download
+    """
+    return Response(
+        stream_with_context(lines),
+        mimetype='application/x-ndjson',
+        headers={"Content-Disposition": f'attachment; filename="{filename}.ndjson"'}
+    )
+
+
+def _import_transcripts(user_id, lines):
+    """
+    Import transcripts and rebuild the conversation state of every imported character,
+    also of the ones imported before an error stopped the import
+    """
+    imported = []
+    try:
+        return transcript_manager.import_transcripts(user_id, lines, imported=imported)
+    finally:
+        # Everything imported is committed, drop what the error left in the session
+        db.session.rollback()
+        for char_id, _ in imported:
+            _rebuild_conversation(user_id, char_id)
+
+
+def _rebuild_conversation(user_id, char_id):
+    """
+    Replace the checkpointed conversation of a chat with its stored summary and the
+    newest messages that fit into the context window
+    """
+    thread_id = int(f"{user_id}{char_id}")
+    config = {"configurable": {"thread_id": thread_id}}
+
+    with turn_scheduler.turn(thread_id):
+        chatbot_app = chatbot.get()
+        chatbot_app.checkpointer.delete_thread(thread_id)
+
+        story_summary = chat_manager.get_summary(user_id, char_id)
+        summary = story_summary.summary if story_summary else ""
+        summarized_through = story_summary.summarized_through if story_summary else 0
+        summary_tokens = story_summary.token_count if story_summary else 0
+
+        window = chat_manager.get_context_window(user_id, char_id, MAX_CONTEXT_TOKENS - summary_tokens,
+                                                 after=summarized_through)
+        if not window:
+            return
+
+        chatbot_app.update_state(
+            config,
+            {"messages": to_messages(window), "language": "English", "summary": summary},
+            as_node="model"
+        )
 
 
 @app.errorhandler(404)
@@ -413,5 +1003,46 @@ def chatbot_not_initialized(e):
     return render_template('503.html'), 503
 
 
+@app.cli.command("export-transcripts")
+@click.argument("username")
+@click.argument("output", type=click.File("w", encoding="utf-8"), default="-")
+@click.option("--character", "char_name", help="Only export this character.")
+def export_transcripts_command(username, output, char_name):
+    """
+    Write the campaigns of a user as NDJSON to OUTPUT (default stdout)
+    """
+    user_id = user_manager.resolve_user(username)
+    if user_id is None:
+        raise click.ClickException(f"User {username} not found.")
+
+    char_id = None
+    if char_name:
+        ids = character_manager.resolve(username, char_name)
+        if not ids:
+            raise click.ClickException(f"Character {char_name} of {username} not found.")
+        char_id = ids[1]
+
+    for line in transcript_manager.export_transcripts(user_id, char_id):
+        output.write(line)
+
+
+@app.cli.command("import-transcripts")
+@click.argument("username")
+@click.argument("input_file", type=click.File("r", encoding="utf-8"), default="-")
+def import_transcripts_command(username, input_file):
+    """
+    Import NDJSON campaigns from INPUT_FILE (default stdin) into a user, creating the user if needed
+    """
+    user_manager.create_user(username)
+    user_id = user_manager.resolve_user(username)
+
+    try:
+        result = _import_transcripts(user_id, input_file)
+    except TranscriptError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f"Imported {result['messages']} messages of {len(result['characters'])} characters.")
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
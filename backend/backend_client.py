@@ -0,0 +1,145 @@
+import json
+import os
+from typing import Iterator, List, NamedTuple, Optional, Tuple, TypedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+BACKEND_URL = os.getenv('BACKEND_URL', "http://localhost:5000")
+
+# Seconds to wait for a connection and for the next bytes of an answer
+CONNECT_TIMEOUT = float(os.getenv('BACKEND_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('BACKEND_READ_TIMEOUT', 60))
+
+# Retries of failed connections and of idempotent requests the backend could not answer
+MAX_RETRIES = int(os.getenv('BACKEND_MAX_RETRIES', 3))
+RETRY_BACKOFF = float(os.getenv('BACKEND_RETRY_BACKOFF', 0.3))
+
+# Connections kept alive to the backend, one per concurrently running Streamlit session
+POOL_SIZE = int(os.getenv('BACKEND_POOL_SIZE', 10))
+
+
+class ChatMessage(TypedDict):
+    chat_id: int
+    role: str
+    messages: str
+
+
+class HistoryPage(NamedTuple):
+    messages: List[ChatMessage]
+    etag: Optional[str]
+    not_modified: bool
+
+
+class BackendError(Exception):
+    """
+    Raised if the backend cannot be reached or answers with an error
+    """
+
+
+class BackendClient:
+    """
+    Client for the chat endpoints of the Flask backend.
+    All requests share one keep-alive session, so an interaction reuses an open
+    connection instead of opening a new one, and every request has a timeout.
+    """
+
+    def __init__(self, base_url: str = BACKEND_URL,
+                 timeout: Tuple[float, float] = (CONNECT_TIMEOUT, READ_TIMEOUT),
+                 max_retries: int = MAX_RETRIES, pool_size: int = POOL_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+        # Connection errors are retried for every method, answers only for GET,
+        # so a message is never sent twice
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            backoff_factor=RETRY_BACKOFF,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Compressed answers are decoded by requests
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+
+    def fetch_history(self, username: str, char_name: str,
+                      after: Optional[int] = None, etag: Optional[str] = None) -> HistoryPage:
+        """
+        Fetch the chat history, or only the messages newer than the chat_id after.
+        With the etag of the last answer the backend answers not_modified if nothing changed.
+        """
+        params = {"after": after} if after is not None else {}
+        headers = {"If-None-Match": etag} if etag else {}
+
+        response = self._request("GET", self._chat_url(username, char_name, "history"),
+                                 params=params, headers=headers)
+
+        if response.status_code == 304:
+            return HistoryPage([], etag, True)
+
+        self._raise_for_status(response)
+        return HistoryPage(response.json(), response.headers.get('ETag'), False)
+
+
+    def send_message(self, username: str, char_name: str, message: str) -> dict:
+        """
+        Send a message and wait until the AI answered
+        """
+        response = self._request("POST", self._chat_url(username, char_name, "chat"),
+                                 json={"message": message})
+        self._raise_for_status(response)
+        return response.json()
+
+
+    def stream_message(self, username: str, char_name: str, message: str) -> Iterator[Tuple[str, dict]]:
+        """
+        Send a message and yield the server-sent events of the answer as (event, payload)
+        """
+        response = self._request("POST", self._chat_url(username, char_name, "chat/stream"),
+                                 json={"message": message}, stream=True)
+
+        with response:
+            self._raise_for_status(response)
+
+            event = "message"
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line.startswith("data:"):
+                        yield event, json.loads(line[len("data:"):])
+                    elif not line:
+                        event = "message"
+            except requests.exceptions.RequestException as e:
+                raise BackendError(f"The answer of the backend broke off: {e}") from e
+
+
+    def _chat_url(self, username, char_name, endpoint):
+        return f"{self.base_url}/users/{username}/characters/{char_name}/{endpoint}"
+
+
+    def _request(self, method, url, **kwargs):
+        try:
+            return self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise BackendError(f"Connection to Flask Backend failed: {e}") from e
+
+
+    @staticmethod
+    def _raise_for_status(response):
+        if response.status_code >= 400:
+            try:
+                message = response.json().get("error", response.text)
+            except ValueError:
+                message = response.text
+            raise BackendError(f"Backend answered {response.status_code}: {message}")
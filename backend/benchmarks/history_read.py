@@ -0,0 +1,123 @@
+"""
+Benchmark for the chat history hot query.
+
+Seeds a temporary SQLite database with a growing number of messages spread over
+many chats and measures how long it takes to read the history of a single chat.
+With the indexes of the schema migrations the read latency stays flat while the
+table grows; run with --no-index to compare against the unindexed schema.
+
+Run from the backend directory:
+    python -m benchmarks.history_read --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.orm import Session
+
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from models import db, User, Character, ChatHistory
+from models.migrations import upgrade
+from data import ChatManager
+
+CHATS = 200 # Number of user/character pairs the messages are spread over
+MESSAGES_PER_CHAT_READ = 200 # Size of the chat that is read
+BATCH_SIZE = 10000
+
+
+def seed(engine, total_messages):
+    """
+    Insert users, characters and random messages until the table holds total_messages rows
+    """
+    with engine.begin() as conn:
+        existing = conn.execute(text("SELECT count(*) FROM chat_history")).scalar()
+
+        if existing == 0:
+            conn.execute(insert(User), [{"user_id": i, "username": f"user{i}"} for i in range(1, CHATS + 1)])
+            conn.execute(insert(Character), [
+                {"char_id": i, "char_name": f"char{i}", "user_id": i,
+                 "strength": 8, "dexterity": 8, "constitution": 8,
+                 "intelligence": 8, "wisdom": 8, "charisma": 8}
+                for i in range(1, CHATS + 1)
+            ])
+
+            # The chat that is read keeps the same size for every table size
+            conn.execute(insert(ChatHistory), [
+                {"message": f"message {n}", "role": "ai" if n % 2 else "character",
+                 "created": datetime.now(), "user_id": 1, "char_id": 1}
+                for n in range(MESSAGES_PER_CHAT_READ)
+            ])
+            existing = MESSAGES_PER_CHAT_READ
+
+        remaining = total_messages - existing
+        while remaining > 0:
+            batch = min(BATCH_SIZE, remaining)
+            rows = []
+            for n in range(batch):
+                chat = random.randint(2, CHATS)
+                rows.append({"message": f"message {n}", "role": "ai" if n % 2 else "character",
+                             "created": datetime.now(), "user_id": chat, "char_id": chat})
+            conn.execute(insert(ChatHistory), rows)
+            remaining -= batch
+
+
+def measure(engine, repeats):
+    """
+    Read the full history and the newest page of the measured chat, return the median in ms
+    """
+    with Session(engine) as session:
+        chat_manager = ChatManager(SimpleNamespace(session=session), ChatHistory)
+
+        full, page = [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            chat_manager.get_history_state(1, 1)
+            chat_manager.get_history(1, 1)
+            full.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            chat_manager.get_history(1, 1, before=10**12, limit=20)
+            page.append((time.perf_counter() - start) * 1000)
+            session.expunge_all()
+
+    return statistics.median(full), statistics.median(page)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 500000],
+                        help="Total numbers of messages in the table to measure at")
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--no-index', action='store_true', help="Skip the migrations to compare")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'benchmark.sqlite')}")
+        db.metadata.create_all(engine)
+
+        if args.no_index:
+            with engine.begin() as conn:
+                for index in ("ix_chat_history_user_char_chat", "ix_chat_history_user_char_created",
+                              "ix_characters_user_name", "ix_characters_char_name"):
+                    conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+        else:
+            upgrade(engine)
+
+        print(f"{'messages':>12} {'full history (ms)':>18} {'newest page (ms)':>17}")
+        for size in sorted(args.sizes):
+            seed(engine, size)
+            full, page = measure(engine, args.repeats)
+            print(f"{size:>12} {full:>18.2f} {page:>17.2f}")
+
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+"""
+End-to-end load test of the chat service.
+
+Boots the Flask app behind a threaded HTTP server against a temporary SQLite
+database and the fake chat model (LLM_PROVIDER=fake), seeds users, characters
+and long histories and drives a weighted mix of roster pages, character pages,
+history loads and chat turns from concurrent clients. Reports throughput and
+p50/p95/p99 latency per route.
+
+Results can be stored as a baseline; later runs are compared against it and
+fail with exit code 1 if the p95 of a route regressed by more than the tolerance.
+Baselines depend on the machine, save one on the machine that runs the comparison.
+
+Run from the backend directory:
+    python -m benchmarks.load_test --concurrency 8 --duration 30
+    python -m benchmarks.load_test --save-baseline
+"""
+import argparse
+import atexit
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+# Set up before the app is imported, removed with everything in it when the run ends
+tmp_dir = tempfile.TemporaryDirectory()
+atexit.register(tmp_dir.cleanup)
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp_dir.name, 'load_test.sqlite')}"
+os.environ['CHECKPOINT_DB_PATH'] = os.path.join(tmp_dir.name, 'checkpoints.sqlite')
+os.environ['IMAGE_STORE_PATH'] = os.path.join(tmp_dir.name, 'images')
+os.environ.setdefault('SECRET_KEY', 'load-test')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('LOG_LEVELS', 'werkzeug=WARNING')
+# A stub model with the timing of a fast hosted model, override with FAKE_LLM_*
+os.environ.setdefault('LLM_PROVIDER', 'fake')
+os.environ.setdefault('FAKE_LLM_LATENCY_MS', '100')
+os.environ.setdefault('FAKE_LLM_TOKENS_PER_SECOND', '200')
+os.environ.setdefault('FAKE_LLM_REPLY_TOKENS', '40')
+# Measure the capacity of the service, not the admission limits
+for limit in ('ADMISSION_USER_RATE', 'ADMISSION_GLOBAL_RATE', 'ADMISSION_MAX_IN_FLIGHT'):
+    os.environ.setdefault(limit, '0')
+
+import requests
+from sqlalchemy import insert
+from werkzeug.serving import make_server
+
+import backend_app
+from models import db, User, Character, ChatHistory
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'load_test.json')
+
+# Relative weight of every route in the traffic
+DEFAULT_MIX = "roster=3,character=1,history=4,chat=2,stream=1"
+
+SEED_BATCH_SIZE = 10000
+
+
+def seed(users, history):
+    """
+    Add users with three characters each and history messages per character
+    """
+    with backend_app.app.app_context():
+        db.session.execute(insert(User), [{"user_id": n, "username": f"user{n}"} for n in range(1, users + 1)])
+        db.session.execute(insert(Character), [
+            {"char_id": n * 10 + c, "char_name": f"char{c}", "user_id": n,
+             "strength": 8, "dexterity": 8, "constitution": 8,
+             "intelligence": 8, "wisdom": 8, "charisma": 8}
+            for n in range(1, users + 1) for c in range(1, 4)
+        ])
+
+        rows = []
+        for n in range(1, users + 1):
+            for c in range(1, 4):
+                for m in range(history):
+                    rows.append({"message": f"Message {m} of the story, the party walks on. " * 3,
+                                 "role": "ai" if m % 2 else "character", "token_count": 30,
+                                 "created": datetime.now(), "user_id": n, "char_id": n * 10 + c})
+                    if len(rows) >= SEED_BATCH_SIZE:
+                        db.session.execute(insert(ChatHistory), rows)
+                        rows = []
+        if rows:
+            db.session.execute(insert(ChatHistory), rows)
+        db.session.commit()
+
+
+def parse_mix(value):
+    """
+    Parse route weights like 'roster=3,history=4,chat=2'
+    """
+    mix = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        route, _, weight = entry.partition("=")
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f"Unknown route {route}, use {', '.join(ROUTES)}")
+        mix[route] = float(weight or 1)
+    return mix
+
+
+def _roster(user, char):
+    return "GET", f"/users/user{user}/characters", {}
+
+
+def _character(user, char):
+    return "GET", f"/users/user{user}/char{char}", {}
+
+
+def _history(user, char):
+    return "GET", f"/users/user{user}/characters/char{char}/history", {}
+
+
+def _chat(user, char):
+    return "POST", f"/users/user{user}/characters/char{char}/chat", {"json": {"message": "I open the door."}}
+
+
+def _stream(user, char):
+    return "POST", f"/users/user{user}/characters/char{char}/chat/stream", {"json": {"message": "I draw my sword."}}
+
+
+ROUTES = {
+    "roster": _roster,
+    "character": _character,
+    "history": _history,
+    "chat": _chat,
+    "stream": _stream,
+}
+
+
+def client(base_url, mix, users, start, deadline, rng, results, lock):
+    """
+    Send requests of the mix until the deadline, record the ones that started after start
+    """
+    session = requests.Session()
+    routes, weights = list(mix), list(mix.values())
+
+    while time.monotonic() < deadline:
+        route = rng.choices(routes, weights)[0]
+        method, path, kwargs = ROUTES[route](rng.randint(1, users), rng.randint(1, 3))
+
+        began = time.monotonic()
+        try:
+            response = session.request(method, base_url + path, timeout=60, **kwargs)
+            failed = response.status_code >= 400
+        except requests.exceptions.RequestException:
+            failed = True
+        duration = time.monotonic() - began
+
+        if began >= start:
+            with lock:
+                results[route].append((duration, failed))
+
+
+def percentile(values, share):
+    """
+    Nearest-rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(share * len(values)) - 1))]
+
+
+def summarize(results, duration):
+    summary = {}
+    for route, samples in results.items():
+        latencies = sorted(d for d, _ in samples)
+        summary[route] = {
+            "requests": len(samples),
+            "errors": sum(1 for _, failed in samples if failed),
+            "throughput": len(samples) / duration,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+        }
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'route':<10} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}")
+    for route, stats in summary.items():
+        print(f"{route:<10} {stats['requests']:>9} {stats['errors']:>7} {stats['throughput']:>8.1f} "
+              f"{stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}")
+
+
+def compare(summary, baseline, tolerance):
+    """
+    Return the routes whose p95 or error count got worse than the baseline allows
+    """
+    regressions = []
+    for route, stats in summary.items():
+        before = baseline["routes"].get(route)
+        if not before:
+            continue
+        if stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{route}: p95 {before['p95_ms']:.1f} ms -> {stats['p95_ms']:.1f} ms")
+        if stats["errors"] > before["errors"]:
+            regressions.append(f"{route}: errors {before['errors']} -> {stats['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=20, help="Seeded users, with three characters each")
+    parser.add_argument('--history', type=int, default=300, help="Seeded messages per character")
+    parser.add_argument('--concurrency', type=int, default=8, help="Concurrent clients")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds of measured traffic")
+    parser.add_argument('--warmup', type=float, default=2, help="Seconds of traffic before measuring")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"Route weights, default {DEFAULT_MIX}")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_PATH, help="Baseline file to compare with or to save")
+    parser.add_argument('--save-baseline', action='store_true', help="Store this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="Allowed p95 growth against the baseline")
+    args = parser.parse_args()
+
+    seed(args.users, args.history)
+
+    server = make_server("127.0.0.1", 0, backend_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    results = {route: [] for route in args.mix}
+    lock = threading.Lock()
+    start = time.monotonic() + args.warmup
+    deadline = start + args.duration
+
+    clients = [
+        threading.Thread(target=client, args=(base_url, args.mix, args.users, start, deadline,
+                                              random.Random(args.seed + i), results, lock))
+        for i in range(args.concurrency)
+    ]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    server.shutdown()
+
+    summary = summarize(results, args.duration)
+    print_summary(summary)
+
+    config = {key: getattr(args, key) for key in ("users", "history", "concurrency", "duration", "seed")}
+    config["mix"] = args.mix
+    config["model"] = {key: value for key, value in os.environ.items() if key.startswith("FAKE_LLM_")}
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({"config": config, "routes": summary}, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    if baseline["config"] != config:
+        print("The baseline was measured with other settings, not comparing")
+        return
+
+    regressions = compare(summary, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
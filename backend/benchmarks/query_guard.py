@@ -0,0 +1,112 @@
+"""
+Guard against N+1 queries in the page and chat routes.
+
+Boots the app against a temporary SQLite database, seeds a growing number of
+users and characters and counts the queries every route needs. Fails with
+exit code 1 if a route's query count grows with the number of users or characters.
+
+Run from the backend directory:
+    python -m benchmarks.query_guard
+tests/test_query_guard.py runs the same check with pytest.
+"""
+import atexit
+import os
+import sys
+import tempfile
+
+# Set up before the app is imported, removed with everything in it when the run ends
+tmp_dir = tempfile.TemporaryDirectory()
+atexit.register(tmp_dir.cleanup)
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp_dir.name, 'query_guard.sqlite')}"
+os.environ['CHECKPOINT_DB_PATH'] = os.path.join(tmp_dir.name, 'checkpoints.sqlite')
+os.environ.setdefault('OPENAI_API_KEY', 'query-guard')
+# Queries are counted, not answers: the pool of openings is filled by the local fake model
+os.environ.setdefault('LLM_PROVIDER', 'fake')
+os.environ.setdefault('FAKE_LLM_LATENCY_MS', '0')
+os.environ.setdefault('FAKE_LLM_TOKENS_PER_SECOND', '0')
+os.environ.setdefault('SECRET_KEY', 'query-guard')
+# No background fill of the pool, it would query tables the guard drops between routes
+os.environ['OPENER_POOL_SIZE'] = '0'
+
+from sqlalchemy import insert, func, select
+
+import backend_app
+from models import db, User, Character, ChatHistory
+from models.query_counter import assert_constant_queries, QueryCountGrowthError
+
+SIZES = [2, 10, 40] # Number of users, every user gets three characters
+
+ROUTES = {
+    "home": "/",
+    "characters of user": "/users/user1/characters",
+    "character page": "/users/user1/char1-1",
+    "chat page": "/users/user1/characters/char1-1/chat",
+    "history": "/users/user1/characters/char1-1/history",
+}
+
+
+def seed(size):
+    """
+    Add users with three characters and a message each, until there are size users
+    """
+    existing = db.session.execute(select(func.count(User.user_id))).scalar()
+
+    for n in range(existing + 1, size + 1):
+        db.session.execute(insert(User), [{"user_id": n, "username": f"user{n}"}])
+        for c in range(1, 4):
+            char_id = n * 10 + c
+            db.session.execute(insert(Character), [{
+                "char_id": char_id, "char_name": f"char{n}-{c}", "user_id": n,
+                "strength": 8, "dexterity": 8, "constitution": 8,
+                "intelligence": 8, "wisdom": 8, "charisma": 8
+            }])
+            db.session.execute(insert(ChatHistory), [{
+                "message": "Once upon a time", "role": "ai", "user_id": n, "char_id": char_id
+            }])
+    db.session.commit()
+
+
+def check_routes():
+    """
+    Count the queries of every route for each of the SIZES.
+    Returns a dict of route name to (counts, error), error is None if the count is constant
+    """
+    app = backend_app.app
+    client = app.test_client()
+    results = {}
+
+    with app.app_context():
+        for name, url in ROUTES.items():
+            # Start every route with an empty database
+            db.drop_all()
+            db.create_all()
+            backend_app.resolution_cache.clear()
+
+            # Warm up caches so only the steady state is counted
+            seed(SIZES[0])
+            client.get(url)
+
+            try:
+                counts = assert_constant_queries(db.engine, lambda: client.get(url), seed, SIZES)
+                results[name] = (counts, None)
+            except QueryCountGrowthError as e:
+                results[name] = (None, e)
+
+    return results
+
+
+def main():
+    failed = False
+
+    for name, (counts, error) in check_routes().items():
+        if error is None:
+            print(f"ok    {name:<20} {counts}")
+        else:
+            print(f"FAIL  {name:<20} {error}")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
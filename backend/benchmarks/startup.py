@@ -0,0 +1,76 @@
+"""
+Benchmark for the import time and cold start of the backend.
+
+Starts fresh Python processes against a temporary database and measures
+how long it takes to import backend_app, to answer the first request and to
+create the chatbot on first use. Also shows which heavy libraries were
+already loaded by the import; the model client, langchain and langgraph
+should only be loaded once a worker needs them.
+
+Run from the backend directory:
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Libraries that should not be loaded by importing the app
+HEAVY_MODULES = ("langchain_core", "langchain_openai", "openai", "langgraph")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import backend_app
+imported = time.perf_counter()
+loaded = [name for name in {heavy!r} if name in sys.modules]
+backend_app.app.test_client().get('/')
+first_request = time.perf_counter()
+backend_app.chatbot.get()
+chatbot = time.perf_counter()
+print(json.dumps({{"import": imported - start, "first_request": first_request - start,
+                  "chatbot": chatbot - first_request, "loaded": loaded}}))
+"""
+
+
+def probe(tmp_dir):
+    """
+    Measure one cold start in a new process
+    """
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{os.path.join(tmp_dir, 'startup.sqlite')}",
+               CHECKPOINT_DB_PATH=os.path.join(tmp_dir, 'checkpoints.sqlite'),
+               SECRET_KEY='startup')
+    # No API key is needed to start, the model client is created on first use
+    env.pop('OPENAI_API_KEY', None)
+
+    output = subprocess.run([sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)],
+                            cwd=BACKEND_DIR, env=env, stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # The first start creates the database, measure warm file caches after it
+        probe(tmp_dir)
+        results = [probe(tmp_dir) for _ in range(args.runs)]
+
+    for key, label in (("import", "import backend_app"), ("first_request", "first request answered"),
+                       ("chatbot", "chatbot created on first use")):
+        print(f"{label:<30} {statistics.median(r[key] for r in results) * 1000:>8.0f} ms")
+
+    print(f"{'loaded by import':<30} {', '.join(results[-1]['loaded']) or 'none of ' + ', '.join(HEAVY_MODULES)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark for the NDJSON export and import of transcripts.
+
+Seeds a temporary SQLite database with one chat of a growing number of messages,
+exports it to a file and imports it into a second user. Reports the throughput
+and the peak Python memory of both directions, which stays flat while the chat grows.
+
+Run from the backend directory:
+    python -m benchmarks.transcripts --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, insert, delete
+from sqlalchemy.orm import Session
+
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from models import db, User, Character, ChatHistory, StorySummary
+from models.migrations import upgrade
+from data import TranscriptManager
+
+BATCH_SIZE = 10000
+
+
+def seed(engine, total_messages):
+    """
+    Create the exporting user with one character and total_messages messages,
+    and an empty user to import into
+    """
+    with engine.begin() as conn:
+        conn.execute(delete(ChatHistory))
+        conn.execute(delete(Character))
+        conn.execute(delete(User))
+        conn.execute(insert(User), [{"user_id": 1, "username": "source"}, {"user_id": 2, "username": "target"}])
+        conn.execute(insert(Character), [{
+            "char_id": 1, "char_name": "char", "user_id": 1,
+            "strength": 8, "dexterity": 8, "constitution": 8,
+            "intelligence": 8, "wisdom": 8, "charisma": 8
+        }])
+
+        remaining = total_messages
+        while remaining > 0:
+            batch = min(BATCH_SIZE, remaining)
+            conn.execute(insert(ChatHistory), [
+                {"message": f"message {n} " * 20, "role": "ai" if n % 2 else "character",
+                 "created": datetime.now(), "token_count": 50, "user_id": 1, "char_id": 1}
+                for n in range(batch)
+            ])
+            remaining -= batch
+
+
+def measure(engine, path):
+    """
+    Export the chat into path and import it again, return seconds and peak MiB of both
+    """
+    results = []
+
+    with Session(engine) as session:
+        transcript_manager = TranscriptManager(SimpleNamespace(session=session),
+                                               User, Character, ChatHistory, StorySummary)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        with open(path, 'w', encoding='utf-8') as output:
+            for line in transcript_manager.export_transcripts(1):
+                output.write(line)
+        results.append((time.perf_counter() - start, tracemalloc.get_traced_memory()[1] / 2**20))
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        with open(path, encoding='utf-8') as lines:
+            transcript_manager.import_transcripts(2, lines)
+        results.append((time.perf_counter() - start, tracemalloc.get_traced_memory()[1] / 2**20))
+        tracemalloc.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help="Numbers of messages in the exported chat")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'benchmark.sqlite')}")
+        db.metadata.create_all(engine)
+        upgrade(engine)
+
+        print(f"{'messages':>12} {'export (msg/s)':>15} {'peak (MiB)':>11} {'import (msg/s)':>15} {'peak (MiB)':>11}")
+        for size in sorted(args.sizes):
+            seed(engine, size)
+            (export_time, export_peak), (import_time, import_peak) = \
+                measure(engine, os.path.join(tmp_dir, 'export.ndjson'))
+            print(f"{size:>12} {size / export_time:>15.0f} {export_peak:>11.1f} "
+                  f"{size / import_time:>15.0f} {import_peak:>11.1f}")
+
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,9 @@
 from .character_manager import CharacterManager
 from .user_manager import UserManager
-from .chat_manager import ChatManager
\ No newline at end of file
+from .chat_manager import ChatManager, ChatNotFoundError
+from .opener_manager import OpenerManager
+from .resolution_cache import ResolutionCache
+from .image_manager import ImageManager
+from .group_commit import GroupCommitWriter, message_to_dict
+from .transcript_manager import TranscriptManager, TranscriptError
+from .job_manager import JobManager
@@ -1,29 +1,47 @@
+from sqlalchemy import select, func, case
+
+from .resolution_cache import ResolutionCache
+
+
 class CharacterManager:
 
-    def __init__(self, db_instance, char_model, user_model):
+    def __init__(self, db_instance, char_model, user_model, resolution_cache=None):
         self.db = db_instance
         self.Character = char_model
         self.User = user_model
+        self.resolution_cache = resolution_cache or ResolutionCache()
 
 
     def create_character(self, char_name,user_id,char_image,
                          appearance,personality,backstory,strength,
-                         dexterity,constitution,intelligence,wisdom,charisma):
+                         dexterity,constitution,intelligence,wisdom,charisma,image_digest=None):
         """
         Create a character and link it to user
         """
-        user = self.db.session.query(self.User).get(user_id)
+        # Username, number of characters and characters of the same name in one query
+        user = self.db.session.execute(
+            select(self.User.username, func.count(self.Character.char_id).label("char_count"),
+                   func.count(case((self.Character.char_name == char_name, 1))).label("same_name"))
+            .outerjoin(self.Character, self.Character.user_id == self.User.user_id)
+            .where(self.User.user_id == user_id)
+            .group_by(self.User.user_id)
+        ).one_or_none()
 
         if not user:
             return "Error: User could not be found."
 
-        if user.created_chars.count() >= 3:
+        # Urls name characters, so the names of the characters of a user are unique
+        if user.same_name:
+            return f"Error: You already have a Character named {char_name}."
+
+        if user.char_count >= 3:
             return "Error: You already have three Characters. You cannot create more."
 
         new_char = self.Character(
             char_name=char_name,
             user_id=user_id,
             char_image=char_image,
+            image_digest=image_digest,
 
             char_appearance=appearance,
             char_personality=personality,
@@ -39,6 +57,8 @@ class CharacterManager:
 
         self.db.session.add(new_char)
         self.db.session.commit()
+
+        self.resolution_cache.invalidate(("char", user.username, char_name))
         return f"{char_name} was successfully created."
 
 
@@ -54,8 +74,88 @@ class CharacterManager:
         self.db.session.delete(char)
         self.db.session.commit()
 
+        self.forget(char_id)
         return f" The Character {char.char_name} was successfully deleted from Database."
 
 
+    def update_character(self, char_id, char_name):
+        """
+        Rename a char
+        """
+        char = self.db.session.get(self.Character, char_id)
+
+        if not char:
+            return "Error: Character could not be found."
+
+        if char_name != char.char_name and self.get_character(char.user_id, char_name):
+            return f"Error: You already have a Character named {char_name}."
+
+        char.char_name = char_name
+        self.db.session.commit()
+
+        self.forget(char_id)
+        return f"The Character {char_name} was successfully updated."
+
+
+    def resolve(self, username, char_name, verify=False):
+        """
+        Get (user_id, char_id) for the names in a url, cached.
+        None if the user has no character with this name.
+        verify=True reads the ids from the database and refreshes the cache, for routes that
+        write: other worker processes only drop a deleted character from their cache after the ttl
+        """
+        key = ("char", username, char_name)
+        ids = None if verify else self.resolution_cache.get(key)
+
+        if ids is None:
+            row = self.db.session.execute(
+                select(self.User.user_id, self.Character.char_id)
+                .join(self.Character, self.Character.user_id == self.User.user_id)
+                .where(
+                    (self.User.username == username),
+                    (self.Character.char_name == char_name)
+                )
+            ).first()
+
+            if row is None:
+                self.resolution_cache.invalidate(key)
+                return None
+
+            ids = (row.user_id, row.char_id)
+            self.resolution_cache.set(key, ids)
+
+        return ids
+
+
+    def forget(self, char_id):
+        """
+        Drop the cached ids of a character, e.g. after it turned out to be deleted by another worker
+        """
+        self.resolution_cache.invalidate_where(
+            lambda key, value: isinstance(value, tuple) and value[1] == char_id
+        )
+
+
+    def get_character(self, user_id, char_name):
+        """
+        Get a character of a user by name, None if the user has no such character
+        """
+        return self.db.session.execute(
+            select(self.Character).where(
+                (self.Character.user_id == user_id),
+                (self.Character.char_name == char_name)
+            )
+        ).scalars().first()
+
+
+    def count_image_references(self, image_digest):
+        """
+        Number of characters that use an image of the image store
+        """
+        return self.db.session.execute(
+            select(func.count(self.Character.char_id)).where(self.Character.image_digest == image_digest)
+        ).scalar()
+
+
     def get_skills(self, skill):
         pass
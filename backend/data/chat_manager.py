@@ -1,33 +1,210 @@
+from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError
+
+from .group_commit import message_to_dict
+
+# Upper bound of messages read to fill a context window
+CONTEXT_MAX_MESSAGES = 200
+
+
+class ChatNotFoundError(LookupError):
+    """
+    Raised if messages are saved for a user or character that does not exist (anymore)
+    """
+
+
 class ChatManager:
 
-    def __init__(self, db_instance, chat_history):
+    def __init__(self, db_instance, chat_history, story_summary=None, group_commit=None):
         self.db = db_instance
         self.ChatHistory = chat_history
+        self.StorySummary = story_summary
+        self.group_commit = group_commit
+
+    def save_messages(self, user_id, char_id, messages, write_behind=True):
+        """
+        Save the messages of a turn, a list of (role, content), in one transaction.
+        A message can also be (role, content, token_count) if its tokens are counted already,
+        else the column default counts them.
+        With a GroupCommitWriter the turn is committed together with the turns
+        of concurrent requests. write_behind=False commits them in the session of
+        the request instead, together with its other pending changes.
+        Returns the written rows as dicts.
+        Raises ChatNotFoundError if the character was deleted, e.g. by another worker process.
+        """
+        rows = []
+        for role, content, *token_count in messages:
+            row = {"message": content, "role": role, "user_id": user_id, "char_id": char_id}
+            if token_count:
+                row["token_count"] = token_count[0]
+            rows.append(row)
+
+        try:
+            if self.group_commit is not None and write_behind:
+                return self.group_commit.submit(rows).result()
+
+            chat_messages = [self.ChatHistory(**row) for row in rows]
+            self.db.session.add_all(chat_messages)
+            # Copied before the commit expires the rows, which would load every row again
+            self.db.session.flush()
+            saved = [message_to_dict(message) for message in chat_messages]
+            self.db.session.commit()
+
+        except IntegrityError as e:
+            self.db.session.rollback()
+            raise ChatNotFoundError(f"Character {char_id} of user {user_id} does not exist") from e
+
+        return saved
 
     def save_ai_message_into_history(self, content, user_id, char_id):
         """
         Save the AI message into the ChatHistory
         """
-        ai_message = self.ChatHistory(
-            message=content,
-            role='ai',
-            user_id=user_id,
-            char_id=char_id
-        )
-        self.db.session.add(ai_message)
-        self.db.session.commit()
+        return self.save_messages(user_id, char_id, [('ai', content)])[0]
 
     def save_char_message_into_history(self, content, user_id, char_id):
         """
-        Save the AI message into the ChatHistory
+        Save the message of the character into the ChatHistory
+        """
+        return self.save_messages(user_id, char_id, [('character', content)])[0]
+
+    def get_history_state(self, user_id, char_id):
         """
+        Get the number of messages and the newest chat_id of a chat,
+        cheap enough to decide if a client already has the newest history
+        """
+        count, last_chat_id = self.db.session.execute(
+            select(func.count(self.ChatHistory.chat_id), func.max(self.ChatHistory.chat_id)).where(
+                (self.ChatHistory.user_id == user_id),
+                (self.ChatHistory.char_id == char_id)
+            )
+        ).one()
+
+        return count, last_chat_id
+
 
-        # Save the message from user
-        new_message = self.ChatHistory(
-            message=content,
-            role='character',
-            user_id=user_id,
-            char_id=char_id
+    def get_history(self, user_id, char_id, after=None, before=None, limit=None):
+        """
+        Get the messages of a chat in the order they were written.
+        after: only messages newer than this chat_id
+        before: only messages older than this chat_id, the newest ones first up to limit
+        """
+        query = select(self.ChatHistory).where(
+            (self.ChatHistory.user_id == user_id),
+            (self.ChatHistory.char_id == char_id)
         )
-        self.db.session.add(new_message)
-        self.db.session.commit()
\ No newline at end of file
+
+        if after is not None:
+            query = query.where(self.ChatHistory.chat_id > after)
+
+        if before is not None:
+            query = query.where(self.ChatHistory.chat_id < before)
+            query = query.order_by(self.ChatHistory.chat_id.desc()).limit(limit)
+            return list(reversed(self.db.session.execute(query).scalars().all()))
+
+        query = query.order_by(self.ChatHistory.chat_id.asc()).limit(limit)
+        return self.db.session.execute(query).scalars().all()
+
+
+    def get_context_window(self, user_id, char_id, max_tokens, after=None, max_messages=CONTEXT_MAX_MESSAGES):
+        """
+        Get the newest messages of a chat that fit into max_tokens, oldest first.
+        Uses the stored token counts with a running sum in the database,
+        so only the newest max_messages rows are read instead of the whole history.
+        after: only messages newer than this chat_id, e.g. the ones not summarized yet
+        """
+        newest = select(
+            self.ChatHistory.chat_id,
+            self.ChatHistory.role,
+            self.ChatHistory.message,
+            self.ChatHistory.token_count
+        ).where(
+            (self.ChatHistory.user_id == user_id),
+            (self.ChatHistory.char_id == char_id),
+            (self.ChatHistory.chat_id > (after or 0))
+        ).order_by(self.ChatHistory.chat_id.desc()).limit(max_messages).subquery()
+
+        running_total = func.sum(func.coalesce(newest.c.token_count, 0)).over(
+            order_by=newest.c.chat_id.desc()
+        ).label("running_total")
+        windowed = select(newest, running_total).subquery()
+
+        return self.db.session.execute(
+            select(windowed)
+            .where(windowed.c.running_total <= max_tokens)
+            .order_by(windowed.c.chat_id.asc())
+        ).all()
+
+
+    def get_summary_chunk(self, user_id, char_id, after, before, max_tokens, max_messages=CONTEXT_MAX_MESSAGES):
+        """
+        Get the oldest messages between two chat_ids that fit into max_tokens, oldest first.
+        The oldest message is always included, so a chunk moves on even past a single long message
+        """
+        oldest = select(
+            self.ChatHistory.chat_id,
+            self.ChatHistory.role,
+            self.ChatHistory.message,
+            self.ChatHistory.token_count
+        ).where(
+            (self.ChatHistory.user_id == user_id),
+            (self.ChatHistory.char_id == char_id),
+            (self.ChatHistory.chat_id > after),
+            (self.ChatHistory.chat_id < before)
+        ).order_by(self.ChatHistory.chat_id.asc()).limit(max_messages).subquery()
+
+        # Tokens of the messages before a row, a row is taken while they are below max_tokens
+        tokens_before = (func.sum(func.coalesce(oldest.c.token_count, 0)).over(
+            order_by=oldest.c.chat_id.asc()
+        ) - func.coalesce(oldest.c.token_count, 0)).label("tokens_before")
+        windowed = select(oldest, tokens_before).subquery()
+
+        return self.db.session.execute(
+            select(windowed)
+            .where(windowed.c.tokens_before < max_tokens)
+            .order_by(windowed.c.chat_id.asc())
+        ).all()
+
+
+    def count_tokens_between(self, user_id, char_id, after, before):
+        """
+        Sum the stored token counts of the messages between two chat_ids
+        """
+        total = self.db.session.execute(
+            select(func.sum(func.coalesce(self.ChatHistory.token_count, 0))).where(
+                (self.ChatHistory.user_id == user_id),
+                (self.ChatHistory.char_id == char_id),
+                (self.ChatHistory.chat_id > after),
+                (self.ChatHistory.chat_id < before)
+            )
+        ).scalar()
+
+        return total or 0
+
+
+    def get_summary(self, user_id, char_id):
+        """
+        Get the running summary of a chat, None if there is none yet
+        """
+        return self.db.session.execute(
+            select(self.StorySummary).where(
+                (self.StorySummary.user_id == user_id),
+                (self.StorySummary.char_id == char_id)
+            )
+        ).scalar_one_or_none()
+
+
+    def save_summary(self, user_id, char_id, summary, summarized_through, token_count):
+        """
+        Save the running summary of a chat and the newest message it covers
+        """
+        story_summary = self.get_summary(user_id, char_id)
+
+        if story_summary is None:
+            story_summary = self.StorySummary(user_id=user_id, char_id=char_id)
+            self.db.session.add(story_summary)
+
+        story_summary.summary = summary
+        story_summary.summarized_through = summarized_through
+        story_summary.token_count = token_count
+        self.db.session.commit()
@@ -0,0 +1,136 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommitWriter:
+    """
+    Write-behind writer for chat messages.
+    Messages of concurrent requests that arrive within a short window are
+    written in one transaction, so there is one commit per group instead of per message.
+    """
+
+    def __init__(self, app, db_instance, chat_history, window=0.005, max_batch=500):
+        self.app = app
+        self.db = db_instance
+        self.ChatHistory = chat_history
+        self.window = window
+        self.max_batch = max_batch
+
+        self._reset()
+
+        # A forked worker starts with an empty queue and its own thread and lock
+        os.register_at_fork(after_in_child=self._reset)
+
+
+    def _reset(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+
+    def submit(self, rows):
+        """
+        Queue the rows of one turn (dicts of ChatHistory columns) to be written together.
+        Returns a Future with the written rows as dicts once their group is committed.
+        """
+        future = Future()
+        self._start()
+        self._queue.put((rows, future))
+        return future
+
+
+    def _start(self):
+        """
+        Start the writer thread on first use, so it is created in the serving process
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="chat-group-commit", daemon=True)
+                self._thread.start()
+
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+
+            # Collect everything that arrives within the window
+            while len(pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._write(pending)
+
+
+    def _write(self, pending):
+        with self.app.app_context():
+            try:
+                self._commit(pending)
+                return
+            except IntegrityError:
+                # A turn of a deleted character must not fail the turns grouped with it
+                self.db.session.rollback()
+            except Exception as e:
+                self.db.session.rollback()
+                logger.exception("Group commit of %d turns failed", len(pending))
+                self._fail(pending, e)
+                return
+
+            for turn in pending:
+                try:
+                    self._commit([turn])
+                except Exception as e:
+                    self.db.session.rollback()
+                    self._fail([turn], e)
+
+
+    def _commit(self, pending):
+        """
+        Write the rows of the pending turns in one transaction and hand every turn its rows
+        """
+        groups = []
+        for rows, future in pending:
+            messages = [self.ChatHistory(**row) for row in rows]
+            self.db.session.add_all(messages)
+            groups.append((messages, future))
+
+        # Copied before the commit expires the rows, which would load every row again
+        self.db.session.flush()
+        results = [(future, [message_to_dict(message) for message in messages]) for messages, future in groups]
+
+        self.db.session.commit()
+
+        for future, saved in results:
+            future.set_result(saved)
+
+
+    @staticmethod
+    def _fail(pending, error):
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(error)
+
+
+def message_to_dict(message):
+    """
+    Plain copy of a written ChatHistory row, usable outside of its session
+    """
+    return {
+        "chat_id": message.chat_id,
+        "role": message.role,
+        "message": message.message,
+        "created": message.created,
+    }
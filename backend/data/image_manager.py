@@ -0,0 +1,53 @@
+from datetime import datetime
+
+from sqlalchemy import select
+
+
+class ImageManager:
+
+    def __init__(self, db_instance, remote_image_model, char_model):
+        self.db = db_instance
+        self.RemoteImage = remote_image_model
+        self.Character = char_model
+
+
+    def get_remote_image(self, url):
+        """
+        Get the mirror of a remote image, None if it was never fetched
+        """
+        return self.db.session.execute(
+            select(self.RemoteImage).where(self.RemoteImage.url == url)
+        ).scalar_one_or_none()
+
+
+    def save_remote_image(self, url, image_digest, etag):
+        """
+        Remember the local copy of a remote image and when it was fetched
+        """
+        remote_image = self.get_remote_image(url)
+
+        if remote_image is None:
+            remote_image = self.RemoteImage(url=url)
+            self.db.session.add(remote_image)
+
+        remote_image.image_digest = image_digest
+        remote_image.etag = etag
+        remote_image.fetched = datetime.now()
+        self.db.session.commit()
+
+
+    def set_character_image(self, char_id, char_image=None, image_digest=None):
+        """
+        Point a character to a new portrait
+        """
+        char = self.db.session.get(self.Character, char_id)
+
+        if not char:
+            return "Error: Character could not be found."
+
+        if char_image is not None:
+            char.char_image = char_image
+        char.image_digest = image_digest
+        self.db.session.commit()
+
+        return f"The portrait of {char.char_name} was updated."
@@ -0,0 +1,66 @@
+import json
+from datetime import datetime
+
+from sqlalchemy import select, insert, update, delete
+
+
+class JobManager:
+    """
+    Stores the state of jobs in the database, so every worker process can answer
+    a poll for a job that was queued on another one
+    """
+
+    def __init__(self, db_instance, job_model):
+        self.db = db_instance
+        self.JobRecord = job_model
+
+
+    def save(self, job):
+        """
+        Insert or update the state of a job. Runs in its own transaction,
+        so pending changes of the request session are neither committed nor lost
+        """
+        values = {
+            "status": job.status,
+            "result": json.dumps(job.result, default=str) if job.result is not None else None,
+            "error": job.error,
+            "finished": datetime.fromtimestamp(job.finished) if job.finished else None,
+        }
+
+        with self.db.engine.begin() as conn:
+            updated = conn.execute(
+                update(self.JobRecord).where(self.JobRecord.job_id == job.job_id).values(**values)
+            )
+            if updated.rowcount == 0:
+                conn.execute(insert(self.JobRecord).values(
+                    job_id=job.job_id, created=datetime.fromtimestamp(job.created), **values))
+
+
+    def get(self, job_id):
+        """
+        Get the state of a job as a dict, None if the job is unknown
+        """
+        with self.db.engine.connect() as conn:
+            record = conn.execute(
+                select(self.JobRecord.status, self.JobRecord.result, self.JobRecord.error)
+                .where(self.JobRecord.job_id == job_id)
+            ).one_or_none()
+
+        if record is None:
+            return None
+
+        return {
+            "job_id": job_id,
+            "status": record.status,
+            "result": json.loads(record.result) if record.result is not None else None,
+            "error": record.error,
+        }
+
+
+    def prune(self, finished_before):
+        """
+        Delete the jobs that finished before a timestamp
+        """
+        with self.db.engine.begin() as conn:
+            conn.execute(delete(self.JobRecord).where(
+                self.JobRecord.finished < datetime.fromtimestamp(finished_before)))
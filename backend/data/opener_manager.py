@@ -0,0 +1,56 @@
+from sqlalchemy import select, delete, func
+
+
+class OpenerManager:
+
+    def __init__(self, db_instance, opener_model):
+        self.db = db_instance
+        self.StoryOpener = opener_model
+
+
+    def add_opener(self, message, language, archetype=None):
+        """
+        Add a ready-made opening scene to the pool
+        """
+        self.db.session.add(self.StoryOpener(message=message, language=language, archetype=archetype))
+        self.db.session.commit()
+
+
+    def count_openers(self, language, archetype=None):
+        """
+        Number of openings left in the pool
+        """
+        return self.db.session.execute(
+            select(func.count(self.StoryOpener.opener_id)).where(
+                (self.StoryOpener.language == language),
+                (self.StoryOpener.archetype.is_(archetype) if archetype is None
+                 else self.StoryOpener.archetype == archetype)
+            )
+        ).scalar()
+
+
+    def claim_opener(self, language, archetype=None, attempts=3):
+        """
+        Take the oldest opening out of the pool and return its message, None if the pool is empty.
+        The opening is deleted with a check of the affected rows, so two requests
+        can never claim the same opening. The caller commits the claim.
+        """
+        for _ in range(attempts):
+            opener = self.db.session.execute(
+                select(self.StoryOpener.opener_id, self.StoryOpener.message).where(
+                    (self.StoryOpener.language == language),
+                    (self.StoryOpener.archetype.is_(archetype) if archetype is None
+                     else self.StoryOpener.archetype == archetype)
+                ).order_by(self.StoryOpener.opener_id).limit(1)
+            ).one_or_none()
+
+            if opener is None:
+                return None
+
+            claimed = self.db.session.execute(
+                delete(self.StoryOpener).where(self.StoryOpener.opener_id == opener.opener_id)
+            )
+            if claimed.rowcount == 1:
+                return opener.message
+
+        return None
@@ -0,0 +1,303 @@
+import json
+from datetime import datetime
+
+from sqlalchemy import select, insert, func
+
+from models.tokens import count_tokens
+
+# Rows fetched per round trip while exporting, and written per transaction while importing
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 1000
+
+# Columns of a character that are part of a transcript
+CHARACTER_FIELDS = (
+    "char_name", "char_image", "char_appearance", "char_personality", "char_backstory",
+    "strength", "dexterity", "constitution", "intelligence", "wisdom", "charisma",
+)
+
+# Text columns of a character and their longest value
+CHARACTER_TEXT_LENGTHS = {
+    "char_name": 100, "char_image": 500, "char_appearance": 1000, "char_personality": 1000, "char_backstory": 2000,
+}
+
+
+class TranscriptError(ValueError):
+    """
+    Raised for a transcript line that cannot be imported
+    """
+
+
+class TranscriptManager:
+    """
+    Export and import the campaigns of a user as NDJSON, one record per line:
+        {"type": "user", ...} once at the start
+        {"type": "character", ...} starts the transcript of a character
+        {"type": "message", ...} for every message of that character, oldest first
+        {"type": "summary", ...} the running summary, after the messages it covers
+    Both directions work on a stream, so the size of a history does not matter.
+    """
+
+    def __init__(self, db_instance, user_model, char_model, chat_history, story_summary):
+        self.db = db_instance
+        self.User = user_model
+        self.Character = char_model
+        self.ChatHistory = chat_history
+        self.StorySummary = story_summary
+
+
+    def export_transcripts(self, user_id, char_id=None):
+        """
+        Yield the NDJSON lines of all characters of a user, or of one character.
+        Messages are read with a server-side cursor in batches of EXPORT_BATCH_SIZE.
+        """
+        username = self.db.session.execute(
+            select(self.User.username).where(self.User.user_id == user_id)
+        ).scalar_one()
+        yield _line({"type": "user", "username": username})
+
+        query = select(self.Character.char_id, *[getattr(self.Character, field) for field in CHARACTER_FIELDS]) \
+            .where(self.Character.user_id == user_id).order_by(self.Character.char_id)
+        if char_id is not None:
+            query = query.where(self.Character.char_id == char_id)
+
+        # A user has only a few characters, the histories are streamed
+        characters = self.db.session.execute(query).all()
+
+        for character in characters:
+            yield _line({"type": "character", **{field: getattr(character, field) for field in CHARACTER_FIELDS}})
+
+            messages = self.db.session.execute(
+                select(self.ChatHistory.role, self.ChatHistory.message,
+                       self.ChatHistory.created, self.ChatHistory.token_count)
+                .where(
+                    (self.ChatHistory.user_id == user_id),
+                    (self.ChatHistory.char_id == character.char_id)
+                )
+                .order_by(self.ChatHistory.chat_id)
+                .execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            for message in messages:
+                yield _line({
+                    "type": "message",
+                    "role": message.role,
+                    "message": message.message,
+                    "created": message.created.isoformat() if message.created else None,
+                    "token_count": message.token_count,
+                })
+
+            summary = self._export_summary(user_id, character.char_id)
+            if summary is not None:
+                yield _line(summary)
+
+
+    def _export_summary(self, user_id, char_id):
+        """
+        The summary refers to its messages by their position, the chat_ids change on import
+        """
+        story_summary = self.db.session.execute(
+            select(self.StorySummary).where(
+                (self.StorySummary.user_id == user_id),
+                (self.StorySummary.char_id == char_id)
+            )
+        ).scalar_one_or_none()
+
+        if story_summary is None:
+            return None
+
+        summarized_messages = self.db.session.execute(
+            select(func.count(self.ChatHistory.chat_id)).where(
+                (self.ChatHistory.user_id == user_id),
+                (self.ChatHistory.char_id == char_id),
+                (self.ChatHistory.chat_id <= story_summary.summarized_through)
+            )
+        ).scalar()
+
+        return {
+            "type": "summary",
+            "summary": story_summary.summary,
+            "summarized_messages": summarized_messages,
+            "token_count": story_summary.token_count,
+        }
+
+
+    def import_transcripts(self, user_id, lines, batch_size=IMPORT_BATCH_SIZE, imported=None):
+        """
+        Import NDJSON lines of an export into the campaigns of a user.
+        Every character is created anew, messages are bulk inserted and committed
+        every batch_size rows. Raises TranscriptError for an invalid line;
+        the characters before it stay imported.
+        Every created character is appended to imported as (char_id, char_name), so a caller
+        also knows them if the import stops with an error.
+        Returns the imported characters and the number of messages
+        """
+        imported = [] if imported is None else imported
+        message_count = 0
+        batch = []
+        char_id = None
+
+        for number, raw_line in enumerate(lines, start=1):
+            if not raw_line.strip():
+                continue
+
+            try:
+                record = json.loads(raw_line)
+            except ValueError as e:
+                raise TranscriptError(f"Line {number} is not valid JSON: {e}")
+
+            record_type = record.get("type") if isinstance(record, dict) else None
+
+            if record_type == "user":
+                continue
+
+            if record_type == "character":
+                self._insert_messages(batch)
+                batch = []
+                char_id = self._create_character(user_id, record, number)
+                imported.append((char_id, record["char_name"]))
+
+            elif record_type == "message":
+                if char_id is None:
+                    raise TranscriptError(f"Line {number}: message before any character.")
+                batch.append(self._message_row(user_id, char_id, record, number))
+                message_count += 1
+
+                if len(batch) >= batch_size:
+                    self._insert_messages(batch)
+                    batch = []
+
+            elif record_type == "summary":
+                if char_id is None:
+                    raise TranscriptError(f"Line {number}: summary before any character.")
+                self._insert_messages(batch)
+                batch = []
+                self._import_summary(user_id, char_id, record, number)
+
+            else:
+                raise TranscriptError(f"Line {number}: unknown record type {record_type!r}.")
+
+        self._insert_messages(batch)
+
+        return {"characters": imported, "messages": message_count}
+
+
+    def _create_character(self, user_id, record, number):
+        values = self._character_values(record, number)
+        char_name = values["char_name"]
+
+        char_names = self.db.session.execute(
+            select(self.Character.char_name).where(self.Character.user_id == user_id)
+        ).scalars().all()
+
+        if char_name in char_names:
+            raise TranscriptError(f"Line {number}: the character {char_name} already exists.")
+
+        if len(char_names) >= 3:
+            raise TranscriptError(f"Line {number}: the user already has three Characters.")
+
+        character = self.Character(user_id=user_id, **values)
+        self.db.session.add(character)
+        self.db.session.commit()
+
+        return character.char_id
+
+
+    def _character_values(self, record, number):
+        """
+        The columns of a character record, checked against the types and lengths of the table
+        """
+        if not isinstance(record.get("char_name"), str) or not record["char_name"].strip():
+            raise TranscriptError(f"Line {number}: character without a name.")
+
+        values = {}
+        for field in CHARACTER_FIELDS:
+            value = record.get(field)
+            if value is None:
+                continue
+
+            if field in CHARACTER_TEXT_LENGTHS:
+                if not isinstance(value, str) or len(value) > CHARACTER_TEXT_LENGTHS[field]:
+                    raise TranscriptError(f"Line {number}: {field} must be a text of at most "
+                                          f"{CHARACTER_TEXT_LENGTHS[field]} characters.")
+            elif not isinstance(value, int) or isinstance(value, bool):
+                raise TranscriptError(f"Line {number}: {field} must be a whole number.")
+
+            values[field] = value
+
+        return values
+
+
+    def _message_row(self, user_id, char_id, record, number):
+        role = record.get("role")
+        message = record.get("message")
+
+        if role not in ("ai", "character") or not isinstance(message, str):
+            raise TranscriptError(f"Line {number}: a message needs a role (ai or character) and a text.")
+
+        try:
+            created = datetime.fromisoformat(record["created"]) if record.get("created") else datetime.now()
+        except (TypeError, ValueError):
+            raise TranscriptError(f"Line {number}: invalid timestamp {record.get('created')!r}.")
+
+        token_count = record.get("token_count")
+        if not isinstance(token_count, int):
+            token_count = count_tokens(message)
+
+        return {"user_id": user_id, "char_id": char_id, "role": role, "message": message,
+                "created": created, "token_count": token_count}
+
+
+    def _insert_messages(self, batch):
+        """
+        Write a batch of messages with one executemany insert and commit it
+        """
+        if not batch:
+            return
+
+        self.db.session.execute(insert(self.ChatHistory), batch)
+        self.db.session.commit()
+
+
+    def _import_summary(self, user_id, char_id, record, number):
+        """
+        Map the position of the newest summarized message to its new chat_id
+        """
+        summarized_messages = record.get("summarized_messages") or 0
+        summary = record.get("summary")
+        token_count = record.get("token_count")
+
+        if not isinstance(summarized_messages, int) or isinstance(summarized_messages, bool) \
+                or (summary is not None and not isinstance(summary, str)):
+            raise TranscriptError(f"Line {number}: a summary needs a text and the number of summarized messages.")
+
+        if not isinstance(token_count, int) or isinstance(token_count, bool):
+            token_count = None
+
+        if not summary or summarized_messages <= 0:
+            return
+
+        summarized_through = self.db.session.execute(
+            select(self.ChatHistory.chat_id)
+            .where(
+                (self.ChatHistory.user_id == user_id),
+                (self.ChatHistory.char_id == char_id)
+            )
+            .order_by(self.ChatHistory.chat_id)
+            .offset(summarized_messages - 1)
+            .limit(1)
+        ).scalar()
+
+        if summarized_through is None:
+            return
+
+        self.db.session.add(self.StorySummary(
+            user_id=user_id,
+            char_id=char_id,
+            summary=summary,
+            summarized_through=summarized_through,
+            token_count=token_count or count_tokens(summary),
+        ))
+        self.db.session.commit()
+
+
+def _line(record):
+    return json.dumps(record, ensure_ascii=False) + "\n"
@@ -1,9 +1,16 @@
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from .resolution_cache import ResolutionCache
+
+
 class UserManager:
 
-    def __init__(self, db_instance, user_model, char_model):
+    def __init__(self, db_instance, user_model, char_model, resolution_cache=None):
         self.db = db_instance
         self.User = user_model
         self.Character = char_model
+        self.resolution_cache = resolution_cache or ResolutionCache()
 
 
     def create_user(self, username):
@@ -26,7 +33,11 @@ class UserManager:
         """
         Retrieve all Users to display them on homepage
         """
-        users = self.db.session.query(self.User).order_by(self.User.username).all()
+        users = self.db.session.execute(
+            select(self.User)
+            .options(selectinload(self.User.created_chars))
+            .order_by(self.User.username)
+        ).scalars().all()
         if users:
             return users
         return []
@@ -43,13 +54,52 @@ class UserManager:
 
         self.db.session.delete(user)
         self.db.session.commit()
+
+        # Forget the user and all of their characters
+        self.resolution_cache.invalidate_where(
+            lambda key, value: value == user_id or (isinstance(value, tuple) and value[0] == user_id)
+        )
         return "User successfully deleted from database."
 
 
+    def resolve_user(self, username, verify=False):
+        """
+        Get the user_id of a username, cached. None if the user does not exist.
+        verify=True reads the id from the database and refreshes the cache, for routes that write
+        """
+        key = ("user", username)
+        user_id = None if verify else self.resolution_cache.get(key)
+
+        if user_id is None:
+            user_id = self.db.session.execute(
+                select(self.User.user_id).where(self.User.username == username)
+            ).scalar_one_or_none()
+
+            if user_id is not None:
+                self.resolution_cache.set(key, user_id)
+            else:
+                self.resolution_cache.invalidate(key)
+
+        return user_id
+
+
     def get_characters(self, user_id):
         """
-        TODO
         Get all characters associated to user as a list
         """
-        user = self.db.session.query(self.User).get(user_id)
-        return user.created_chars.order_by(self.Character.char_name).all()
+        return self.db.session.execute(
+            select(self.Character)
+            .where(self.Character.user_id == user_id)
+            .order_by(self.Character.char_name)
+        ).scalars().all()
+
+
+    def get_user_with_characters(self, username):
+        """
+        Get a user together with their characters in two queries, None if the user does not exist
+        """
+        return self.db.session.execute(
+            select(self.User)
+            .options(selectinload(self.User.created_chars))
+            .where(self.User.username == username)
+        ).scalar_one_or_none()
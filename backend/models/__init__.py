@@ -2,5 +2,11 @@ from .db import db
 from .users import User
 from .characters import Character
 from .application import create_app
-from .chat_bot import create_chatbot
 from .chat_history import ChatHistory
+from .story_summary import StorySummary
+from .story_opener import StoryOpener
+from .remote_image import RemoteImage
+from .tokens import count_tokens
+from .llm_providers import create_model, register_provider
+from .model_router import ModelRouter, ModelUnavailableError
+from .job_record import JobRecord
@@ -1,11 +1,17 @@
 import os
 from dotenv import load_dotenv
 from flask import Flask
+from sqlalchemy import event
 
 from .db import db
+from .migrations import upgrade
 
 from .users import User
 from .characters import Character
+from .story_summary import StorySummary
+from .story_opener import StoryOpener
+from .remote_image import RemoteImage
+from .job_record import JobRecord
 
 # Define project root path relative to current file to find templates
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -15,9 +21,78 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # app = Flask(__name__, template_folder=TEMPLATE_DIR)
 
 
-def create_app():
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    return value.lower() in ('1', 'true', 'yes') if value else default
+
+
+def sqlite_profile():
+    """
+    Settings for SQLite: write-ahead log so reads do not wait for writes,
+    wait for locks instead of failing and larger caches.
+    Foreign keys are enforced, so a message of a character deleted by another
+    worker fails instead of being written for a character that no longer exists.
+    Configure with SQLITE_BUSY_TIMEOUT_MS, SQLITE_MMAP_SIZE and SQLITE_CACHE_SIZE_KB
+    """
+    return {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000),
+            "mmap_size": _env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+            # Negative values are KiB instead of pages
+            "cache_size": -_env_int('SQLITE_CACHE_SIZE_KB', 64 * 1024),
+            "foreign_keys": "ON",
+        },
+        "engine_options": {
+            "connect_args": {"timeout": _env_int('SQLITE_BUSY_TIMEOUT_MS', 5000) / 1000},
+        },
+    }
+
+
+def server_profile():
+    """
+    Settings for server databases like PostgreSQL or MySQL: a connection pool
+    Configure with DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_PRE_PING and DB_POOL_RECYCLE
+    """
+    return {
+        "pragmas": {},
+        "engine_options": {
+            "pool_size": _env_int('DB_POOL_SIZE', 10),
+            "max_overflow": _env_int('DB_MAX_OVERFLOW', 20),
+            "pool_pre_ping": _env_bool('DB_POOL_PRE_PING', True),
+            "pool_recycle": _env_int('DB_POOL_RECYCLE', 1800),
+        },
+    }
+
+
+def engine_profile(database_uri):
+    """
+    Choose the engine profile for a database uri
+    """
+    if database_uri.startswith("sqlite"):
+        return sqlite_profile()
+    return server_profile()
+
+
+def _set_sqlite_pragmas(pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return on_connect
+
+
+def create_app(config=None):
     """
     Configurates the Flask App
+    :param config: optional settings that override the defaults, e.g. SQLALCHEMY_DATABASE_URI
     :return:
     """
 
@@ -35,14 +110,29 @@ def create_app():
 
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
 
-    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
+    # DATABASE_URL can point to another database, e.g. postgresql://...
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', f"sqlite:///{db_path}")
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.update(config or {})
+
+    profile = engine_profile(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', profile["engine_options"])
 
     # Initialize database with Flask
     db.init_app(app)
 
-    # Create tables
+    # Create tables, then upgrade existing databases in place
     with app.app_context():
+        if profile["pragmas"]:
+            event.listen(db.engine, "connect", _set_sqlite_pragmas(profile["pragmas"]))
+
         db.create_all()
+        upgrade(db.engine)
+
+        # Workers forked from this process open their own connections on first use,
+        # pooled connections of the parent must not be shared with them
+        engine = db.engine
+        engine.dispose()
+        os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
 
-    return app
\ No newline at end of file
+    return app
@@ -1,6 +1,6 @@
 from typing import List
 
-from sqlalchemy import ForeignKey, String, Integer
+from sqlalchemy import ForeignKey, String, Integer, Index
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 
 from .db import db
@@ -20,11 +20,17 @@ class Character(db.Model):
     """
     __tablename__ = "characters"
 
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        Index('ix_characters_user_name', 'user_id', 'char_name'),
+        Index('ix_characters_char_name', 'char_name'),
+        {'extend_existing': True}
+    )
 
     char_id:Mapped[int] = mapped_column(primary_key = True)
     char_name:Mapped[str] = mapped_column(String(100), nullable = False)
     char_image:Mapped[str] = mapped_column(String(500), nullable=True)
+    # sha256 of an uploaded portrait in the image store, None for placeholder and remote images
+    image_digest:Mapped[str] = mapped_column(String(64), nullable=True, index=True)
 
     char_personality:Mapped[str] = mapped_column(String(1000), nullable=True)
     char_backstory:Mapped[str] = mapped_column(String(2000), nullable=True)
@@ -42,6 +48,8 @@ class Character(db.Model):
 
     chat_sessions:Mapped[List["ChatHistory"]] = relationship(back_populates="through_char",
                                                lazy="select", cascade="all, delete-orphan")
+    story_summaries:Mapped[List["StorySummary"]] = relationship(back_populates="through_char",
+                                               lazy="select", cascade="all, delete-orphan")
 
     def __str__(self):
         return f"Name: {self.name} has following skills:"
@@ -1,40 +1,62 @@
+import logging
 import os
-import getpass
+import time
 from dotenv import load_dotenv
+from functools import lru_cache
 from typing import Sequence, Annotated, TypedDict
 
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import BaseMessage, trim_messages
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from .tokens import count_message_tokens
+from .model_router import ModelRouter, parse_routes, parse_budgets
 
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.graph import START, StateGraph
-from langgraph.graph.message import add_messages
+from services.metrics import observe_model_call
+from services.process_local import ProcessLocal
 
-# Define here which chatbot to use TODO let user choose
-CHATBOT_MODEL = 'gpt-4o-mini'
+# Model of every route that MODEL_ROUTES does not configure
+CHATBOT_MODEL = os.getenv('CHATBOT_MODEL', 'gpt-4o-mini')
 
-load_dotenv()
+# Models tried in order per route, e.g. 'action=gpt-4o-mini,gpt-4o;opening=gpt-4o,gpt-4o-mini'.
+# Routes are action (short player messages), turn (other messages), opening and summarize
+MODEL_ROUTES = os.getenv('MODEL_ROUTES', '')
+
+# Seconds a model may take per call before the next model of the route is tried, e.g. 'action=10,opening=30'
+MODEL_BUDGETS = os.getenv('MODEL_BUDGETS', '')
+DEFAULT_MODEL_BUDGET = float(os.getenv('DEFAULT_MODEL_BUDGET', 30))
+
+# Player messages up to this many tokens are short actions
+SHORT_ACTION_TOKENS = int(os.getenv('SHORT_ACTION_TOKENS', 20))
+
+# Tokens of history sent to the model
+MAX_CONTEXT_TOKENS = 2000
+
+# Tokens of old turns outside the window that are folded into the summary at once
+SUMMARY_THRESHOLD_TOKENS = 1000
+
+# Most tokens of old turns folded into the summary per turn, a long backlog is folded chunk by chunk
+SUMMARY_CHUNK_TOKENS = 4000
+
+# Message that asks the model for the beginning of a story
+OPENING_REQUEST = "Start the story."
 
-# load LangSmith API Key and GPT API Key
-if not os.environ.get('OPENAI_API_KEY'):
-    openai_key = os.getenv('OPENAI_API_KEY')
-    if openai_key:
-        os.environ['OPENAI_API_KEY'] = openai_key
-    else:
-        os.environ['OPENAI_API_KEY'] = getpass.getpass("Enter API key for OpenAI: ")
+logger = logging.getLogger(__name__)
 
+load_dotenv()
+
+# load LangSmith API Key
 if not os.environ.get('LANGSMITH_API_KEY'):
     os.environ['LANGSMITH_API_KEY'] = "true"
     os.environ['LANGSMITH_API_KEY'] = os.getenv('LANGSMITH_API_KEY')
 
-# Initiate AI model
-model = ChatOpenAI(model=CHATBOT_MODEL, temperature=0.7)
 
-# Define State
-class State(TypedDict):
-    messages: Annotated[Sequence[BaseMessage], add_messages]
-    language: str
+def _create_router():
+    # The clients of the provider (LLM_PROVIDER) are only loaded once a process talks to a model,
+    # a missing OPENAI_API_KEY fails here instead of prompting at import
+    routes = {route: [CHATBOT_MODEL] for route in ("action", "turn", "opening", "summarize")}
+    routes.update(parse_routes(MODEL_ROUTES))
+    return ModelRouter(routes, parse_budgets(MODEL_BUDGETS), default_budget=DEFAULT_MODEL_BUDGET)
+
+
+# Model router of this process, created on first use
+router = ProcessLocal(_create_router)
 
 #Create system prompt
 # TODO Factor in the character, rework prompt
@@ -46,41 +68,176 @@ system_prompt = (
             "**Respond in the {language} language.**"
 )
 
-
-# Create prompt template
-prompt_template = ChatPromptTemplate.from_messages(
-    [
-        ("system",system_prompt),
-        MessagesPlaceholder(variable_name="messages"),
-    ]
+# Prompt to fold old turns into the running summary
+summary_prompt = (
+            "You keep the summary of a story that a dungeon master tells a player. "
+            "Extend the summary with the new events, keep names, places, items and open choices. "
+            "Answer only with the summary in 300 words or less, in the {language} language."
 )
 
+
+# langchain is only loaded once a process builds a prompt, not by importing the app
+@lru_cache(maxsize=1)
+def _prompt_template():
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system",system_prompt),
+            MessagesPlaceholder(variable_name="messages"),
+        ]
+    )
+
+
+@lru_cache(maxsize=1)
+def _summary_prompt_template():
+    from langchain_core.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", summary_prompt),
+            ("human", "Summary so far:\n{summary}\n\nNew events:\n{events}"),
+        ]
+    )
+
+
 # Define a trimmer for history managment
-trimmer = trim_messages(
-    max_tokens=2000,
-    strategy="last",
-    token_counter=model,
-    include_system=True,
-    allow_partial=False,
-    start_on="human",
-)
+@lru_cache(maxsize=1)
+def _trimmer():
+    from langchain_core.messages import trim_messages
+    return trim_messages(
+        max_tokens=MAX_CONTEXT_TOKENS,
+        strategy="last",
+        token_counter=count_message_tokens,
+        include_system=True,
+        allow_partial=False,
+        start_on="human",
+    )
+
+
+def to_message(role, content, token_count=None):
+    """
+    Convert a message of the ChatHistory into a langchain message, keeping its token count
+    """
+    from langchain_core.messages import HumanMessage, AIMessage
+
+    message_class = AIMessage if role == 'ai' else HumanMessage
+    if token_count is None:
+        return message_class(content=content)
+    return message_class(content=content, additional_kwargs={"token_count": token_count})
+
+
+def to_messages(chat_history):
+    """
+    Convert ChatHistory rows into langchain messages, keeping their stored token count
+    """
+    return [to_message(row.role, row.message, row.token_count) for row in chat_history]
+
+
+def invoke_model(prompt, node, route=None, on_token=None, on_reset=None):
+    """
+    Call the models of the route (default the node) and record latency and token usage for the node
+    """
+    start = time.perf_counter()
+    response = router.get().invoke(prompt, route or node, on_token=on_token, on_reset=on_reset)
+    observe_model_call(node, time.perf_counter() - start, response)
+    return response
+
+
+def action_route(message):
+    """
+    Route of a player message, short actions go to the action models
+    """
+    token_count = message.additional_kwargs.get("token_count") or count_message_tokens([message])
+    return "action" if token_count <= SHORT_ACTION_TOKENS else "turn"
+
+
+def generate_opening(language):
+    """
+    Let the model write the beginning of a story outside of any conversation,
+    used to fill the pool of ready-made openings
+    """
+    prompt = _prompt_template().invoke({
+        "messages": [to_message('character', OPENING_REQUEST)],
+        "language": language
+    })
+    return invoke_model(prompt, "opening").content
+
 
 # Define the graph
-def create_chatbot():
+def create_chatbot(checkpointer=None):
+    # langgraph is only loaded once a process needs the graph
+    from langchain_core.messages import BaseMessage, AIMessage, SystemMessage, RemoveMessage
+    from langgraph.config import get_stream_writer
+    from langgraph.graph import START, StateGraph
+    from langgraph.graph.message import add_messages, REMOVE_ALL_MESSAGES
+
+    from .checkpointer import create_checkpointer
+
+    # Define State
+    class State(TypedDict):
+        # Only the newest turn, the whole history is kept in the ChatHistory
+        messages: Annotated[Sequence[BaseMessage], add_messages]
+        language: str
+        # Newest messages within MAX_CONTEXT_TOKENS, selected before the graph runs
+        window: Sequence[BaseMessage]
+        # Running summary of the story before the window
+        summary: str
+        # Old turns that still have to be folded into the summary
+        overflow: Sequence[BaseMessage]
+        # True once the overflow of this turn is folded into the summary
+        summarized: bool
+
     workflow = StateGraph(state_schema=State)
 
+    def summarize(state:State):
+        # Fold old turns into the running summary, only when there are enough of them
+        if not state.get("overflow"):
+            return {}
+
+        events = "\n".join(
+            f"{'Dungeon master' if isinstance(message, AIMessage) else 'Player'}: {message.content}"
+            for message in state["overflow"]
+        )
+        prompt = _summary_prompt_template().invoke({
+            "summary": state.get("summary") or "The story has just begun.",
+            "events": events,
+            "language": state["language"]
+        })
+        try:
+            response = invoke_model(prompt, "summarize")
+        except Exception:
+            # The turn is answered from the window, the chunk is folded in a later turn
+            logger.exception("Folding old turns into the summary failed")
+            return {"overflow": []}
+        return {"summary": response.content, "overflow": [], "summarized": True}
+
     def call_model(state:State):
-        #Trim messages
-        trimmed_messages = trimmer.invoke(state["messages"])
-        prompt = prompt_template.invoke({
+        # Use the window selected from the stored token counts, else trim the messages
+        trimmed_messages = state.get("window") or _trimmer().invoke(state["messages"])
+
+        if state.get("summary"):
+            trimmed_messages = [SystemMessage(content=f"The story so far: {state['summary']}")] + list(trimmed_messages)
+
+        prompt = _prompt_template().invoke({
             "messages": trimmed_messages,
             "language": state["language"]
         })
-        response = model.invoke(prompt)
-        return {"messages": [response]}
-
-    workflow.add_edge(START, "model")
+        # Tokens are streamed by the router (stream_mode="custom"), so a reply of an abandoned
+        # model never reaches the client and a restarted reply is announced with reset
+        write = get_stream_writer()
+        response = invoke_model(prompt, "model", route=action_route(state["messages"][-1]),
+                                on_token=lambda token: write({"token": token}),
+                                on_reset=lambda: write({"reset": True}))
+        # The history lives in the ChatHistory, the checkpoint only keeps the newest turn
+        # and drops the window, so it does not grow with every turn
+        return {"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), state["messages"][-1], response],
+                "window": []}
+
+    workflow.add_edge(START, "summarize")
+    workflow.add_node("summarize", summarize)
+    workflow.add_edge("summarize", "model")
     workflow.add_node("model", call_model)
 
-    memory = MemorySaver()
-    return workflow.compile(checkpointer=memory)
\ No newline at end of file
+    # Conversations are kept on disk and shared between worker processes
+    if checkpointer is None:
+        checkpointer = create_checkpointer()
+    return workflow.compile(checkpointer=checkpointer)
\ No newline at end of file
@@ -1,9 +1,10 @@
 from datetime import datetime
 
-from sqlalchemy import ForeignKey, String, Text, DateTime
+from sqlalchemy import ForeignKey, String, Text, DateTime, Index, Integer
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 
 from .db import db
+from .tokens import default_token_count
 
 class ChatHistory(db.Model):
     """
@@ -11,12 +12,19 @@ class ChatHistory(db.Model):
     """
     __tablename__ = "chat_history"
 
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # History reads filter on the chat partners and page by chat_id
+        Index('ix_chat_history_user_char_chat', 'user_id', 'char_id', 'chat_id'),
+        Index('ix_chat_history_user_char_created', 'user_id', 'char_id', 'created'),
+        {'extend_existing': True}
+    )
 
     chat_id:Mapped[int] = mapped_column(primary_key = True)
     message:Mapped[str] = mapped_column(Text, nullable=False)
     role:Mapped[str] = mapped_column(String, nullable=False)
     created:Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    # Counted once when the message is written, used to fill the context window
+    token_count:Mapped[int] = mapped_column(Integer, nullable=True, default=default_token_count)
 
     user_id:Mapped[int] = mapped_column(ForeignKey("users.user_id"))
     chatted_with:Mapped["User"] = relationship(back_populates="chats")
@@ -0,0 +1,173 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from langgraph.checkpoint.base import CheckpointTuple, get_checkpoint_id, get_checkpoint_metadata
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+# Define dir for the checkpoint database, beside the story database
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+CHECKPOINT_DB_PATH = os.path.join(DATA_DIR, 'checkpoints.sqlite')
+
+# Number of hot threads kept in memory
+CHECKPOINT_CACHE_SIZE = 256
+
+# Newest checkpoints kept per thread, older ones are deleted
+CHECKPOINT_KEEP = 10
+
+
+class CachedSqliteSaver(SqliteSaver):
+    """
+    SQLite checkpointer that keeps the latest checkpoint of the most recently
+    used threads in a LRU cache. Idle threads are evicted and only live on disk.
+
+    Before a cached checkpoint is used, the latest checkpoint id of the thread is
+    looked up, so checkpoints written by other worker processes are never missed.
+    Only the newest keep checkpoints of a thread are kept on disk.
+    """
+
+    def __init__(self, conn, cache_size=CHECKPOINT_CACHE_SIZE, keep=CHECKPOINT_KEEP):
+        super().__init__(conn)
+        self.cache_size = cache_size
+        self.keep = keep
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+
+    def get_tuple(self, config):
+        """
+        Get the latest checkpoint of a thread from the cache, or from disk on a miss
+        """
+        if get_checkpoint_id(config):
+            return super().get_tuple(config)
+
+        key = self._cache_key(config)
+        version = self._latest_version(key)
+
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached and cached[0] == version:
+                self._cache.move_to_end(key)
+                return cached[1]
+
+        checkpoint_tuple = super().get_tuple(config)
+        if checkpoint_tuple is not None:
+            self._remember(key, version, checkpoint_tuple)
+
+        return checkpoint_tuple
+
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+        key = self._cache_key(config)
+        self._prune(key)
+
+        # The new checkpoint is the latest one of the thread and has no pending writes yet.
+        # Cached as it would be read back from disk, the graph keeps using its own copy
+        thread_id, checkpoint_ns = key
+        parent_id = config["configurable"].get("checkpoint_id")
+        checkpoint_tuple = CheckpointTuple(
+            {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                              "checkpoint_id": checkpoint["id"]}},
+            self.serde.loads_typed(self.serde.dumps_typed(checkpoint)),
+            self.jsonplus_serde.loads(self.jsonplus_serde.dumps(get_checkpoint_metadata(config, metadata))),
+            {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns,
+                              "checkpoint_id": parent_id}} if parent_id else None,
+            [],
+        )
+        self._remember(key, (checkpoint["id"], 0), checkpoint_tuple)
+        return next_config
+
+
+    def put_writes(self, config, writes, task_id, task_path=""):
+        super().put_writes(config, writes, task_id, task_path)
+        self._forget(self._cache_key(config))
+
+
+    def delete_thread(self, thread_id):
+        super().delete_thread(thread_id)
+        with self._cache_lock:
+            for key in [key for key in self._cache if key[0] == str(thread_id)]:
+                del self._cache[key]
+
+
+    def _latest_version(self, key):
+        """
+        Cheap lookup of the latest checkpoint id and its number of pending writes
+        """
+        thread_id, checkpoint_ns = key
+        with self.cursor(transaction=False) as cur:
+            cur.execute(
+                "SELECT c.checkpoint_id, "
+                "(SELECT count(*) FROM writes w WHERE w.thread_id = c.thread_id "
+                "AND w.checkpoint_ns = c.checkpoint_ns AND w.checkpoint_id = c.checkpoint_id) "
+                "FROM checkpoints c WHERE c.thread_id = ? AND c.checkpoint_ns = ? "
+                "ORDER BY c.checkpoint_id DESC LIMIT 1",
+                (thread_id, checkpoint_ns),
+            )
+            return cur.fetchone()
+
+
+    def _prune(self, key):
+        """
+        Delete all but the newest keep checkpoints of a thread and their writes
+        """
+        if not self.keep:
+            return
+
+        thread_id, checkpoint_ns = key
+        with self.cursor() as cur:
+            cur.execute(
+                "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? "
+                "ORDER BY checkpoint_id DESC LIMIT 1 OFFSET ?",
+                (thread_id, checkpoint_ns, self.keep - 1),
+            )
+            oldest_kept = cur.fetchone()
+            if oldest_kept is None:
+                return
+
+            for table in ("checkpoints", "writes"):
+                cur.execute(
+                    f"DELETE FROM {table} WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id < ?",
+                    (thread_id, checkpoint_ns, oldest_kept[0]),
+                )
+
+
+    def _remember(self, key, version, checkpoint_tuple):
+        with self._cache_lock:
+            self._cache[key] = (version, checkpoint_tuple)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+
+    def _forget(self, key):
+        with self._cache_lock:
+            self._cache.pop(key, None)
+
+
+    @staticmethod
+    def _cache_key(config):
+        configurable = config["configurable"]
+        return str(configurable["thread_id"]), configurable.get("checkpoint_ns", "")
+
+
+def create_checkpointer(db_path=None, cache_size=None, keep=None):
+    """
+    Open the checkpoint database beside the story database.
+    Path, cache size and kept checkpoints per thread can be configured with
+    CHECKPOINT_DB_PATH, CHECKPOINT_CACHE_SIZE and CHECKPOINT_KEEP.
+    """
+    db_path = db_path or os.getenv('CHECKPOINT_DB_PATH', CHECKPOINT_DB_PATH)
+    cache_size = cache_size or int(os.getenv('CHECKPOINT_CACHE_SIZE', CHECKPOINT_CACHE_SIZE))
+    keep = keep if keep is not None else int(os.getenv('CHECKPOINT_KEEP', CHECKPOINT_KEEP))
+
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    # Several worker processes share the file, wait for locks instead of failing
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    checkpointer = CachedSqliteSaver(conn, cache_size=cache_size, keep=keep)
+    checkpointer.setup()
+
+    return checkpointer
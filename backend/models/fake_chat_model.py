@@ -0,0 +1,107 @@
+import hashlib
+import random
+import time
+from typing import Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk
+
+from .tokens import count_message_tokens
+
+# Words the fake replies are made of
+VOCABULARY = (
+    "the", "dragon", "a", "torch", "flickers", "you", "hear", "steps", "in", "dark", "tunnel",
+    "an", "old", "map", "shows", "hidden", "door", "beyond", "river", "goblins", "whisper",
+    "your", "sword", "glows", "tavern", "keeper", "offers", "quest", "gold", "and", "danger",
+    "will", "you", "open", "chest", "or", "follow", "stranger", "into", "forest",
+)
+
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "lognormal")
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Local chat model for load tests and benchmarks, no network or API key needed.
+
+    The reply and the timing only depend on the seed and the last prompt message,
+    so runs are reproducible. Before the first token it waits a latency drawn from
+    latency_distribution:
+        constant: latency_ms
+        uniform: latency_ms +- latency_jitter_ms
+        lognormal: median latency_ms with the shape latency_sigma
+    Then it streams reply_tokens words at tokens_per_second (0 for no delay).
+    """
+
+    model_name: str = "fake"
+    latency_ms: float = 0
+    latency_distribution: str = "constant"
+    latency_jitter_ms: float = 0
+    latency_sigma: float = 0.5
+    tokens_per_second: float = 0
+    reply_tokens: int = 50
+    seed: int = 0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+
+    @property
+    def _identifying_params(self):
+        return {"model_name": self.model_name, "seed": self.seed}
+
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return generate_from_stream(self._stream(messages, stop=stop, **kwargs))
+
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs) -> Iterator[ChatGenerationChunk]:
+        rng = self._random(messages)
+        time.sleep(self._sample_latency(rng))
+
+        words = [rng.choice(VOCABULARY) for _ in range(self.reply_tokens)]
+        delay = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+
+        for i, word in enumerate(words):
+            if delay:
+                time.sleep(delay)
+
+            text = word if i == 0 else f" {word}"
+            usage = None
+            if i == len(words) - 1:
+                input_tokens = count_message_tokens(messages)
+                usage = {"input_tokens": input_tokens, "output_tokens": len(words),
+                         "total_tokens": input_tokens + len(words)}
+
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=text, usage_metadata=usage))
+            if run_manager:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+
+    def _random(self, messages):
+        """
+        Random numbers for one call, seeded with the seed and the last message
+        """
+        last = str(messages[-1].content) if messages else ""
+        digest = hashlib.sha256(f"{self.seed}:{last}".encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+    def _sample_latency(self, rng):
+        """
+        Seconds to wait before the first token
+        """
+        if self.latency_distribution == "uniform":
+            latency = rng.uniform(self.latency_ms - self.latency_jitter_ms, self.latency_ms + self.latency_jitter_ms)
+        elif self.latency_distribution == "lognormal":
+            latency = rng.lognormvariate(0, self.latency_sigma) * self.latency_ms
+        elif self.latency_distribution == "constant":
+            latency = self.latency_ms
+        else:
+            raise ValueError(f"Unknown latency distribution {self.latency_distribution}, "
+                             f"use one of {', '.join(LATENCY_DISTRIBUTIONS)}")
+
+        return max(latency, 0) / 1000
@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from sqlalchemy import String, Text, DateTime
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .db import db
+
+class JobRecord(db.Model):
+    """
+    Class for the state of a queued job, shared by all worker processes, with:
+        the identifier of the job (job_id)
+        the status: queued, running, done or failed
+        the result as JSON or the error once it finished
+        the time it finished, finished jobs are deleted after a while
+    """
+    __tablename__ = "jobs"
+
+    __table_args__ = {'extend_existing': True}
+
+    job_id:Mapped[str] = mapped_column(String(32), primary_key = True)
+    status:Mapped[str] = mapped_column(String(20), nullable=False)
+    result:Mapped[str] = mapped_column(Text, nullable=True)
+    error:Mapped[str] = mapped_column(Text, nullable=True)
+    created:Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    finished:Mapped[datetime] = mapped_column(DateTime, nullable=True, index=True)
@@ -0,0 +1,67 @@
+import os
+
+# Provider used if LLM_PROVIDER is not set
+DEFAULT_PROVIDER = "openai"
+
+# Name of a provider to the function that creates its chat model
+PROVIDERS = {}
+
+
+def register_provider(name, factory):
+    """
+    Make a chat model provider selectable with LLM_PROVIDER.
+    The factory is called with the model name and returns a langchain chat model
+    """
+    PROVIDERS[name] = factory
+
+
+def create_model(model_name, provider=None, **options):
+    """
+    Create the chat model of the configured provider (LLM_PROVIDER, default openai)
+    """
+    provider = provider or os.getenv('LLM_PROVIDER', DEFAULT_PROVIDER)
+
+    if provider not in PROVIDERS:
+        raise ValueError(f"Unknown LLM provider {provider}, registered are: {', '.join(sorted(PROVIDERS))}")
+
+    return PROVIDERS[provider](model_name, **options)
+
+
+def _openai(model_name, **options):
+    # Only loaded if the provider is used
+    from langchain_openai import ChatOpenAI
+    options.setdefault("temperature", 0.7)
+    return ChatOpenAI(model=model_name, stream_usage=True, **options)
+
+
+def fake_model_settings():
+    """
+    Settings of the fake model from the environment:
+        FAKE_LLM_LATENCY_MS: (median) time to the first token
+        FAKE_LLM_LATENCY_DISTRIBUTION: constant, uniform or lognormal
+        FAKE_LLM_LATENCY_JITTER_MS: spread of the uniform distribution
+        FAKE_LLM_LATENCY_SIGMA: shape of the lognormal distribution
+        FAKE_LLM_TOKENS_PER_SECOND: streaming rate, 0 for no delay
+        FAKE_LLM_REPLY_TOKENS: words per reply
+        FAKE_LLM_SEED: seed of replies and latencies
+    """
+    return {
+        "latency_ms": float(os.getenv('FAKE_LLM_LATENCY_MS', 200)),
+        "latency_distribution": os.getenv('FAKE_LLM_LATENCY_DISTRIBUTION', "lognormal"),
+        "latency_jitter_ms": float(os.getenv('FAKE_LLM_LATENCY_JITTER_MS', 50)),
+        "latency_sigma": float(os.getenv('FAKE_LLM_LATENCY_SIGMA', 0.5)),
+        "tokens_per_second": float(os.getenv('FAKE_LLM_TOKENS_PER_SECOND', 50)),
+        "reply_tokens": int(os.getenv('FAKE_LLM_REPLY_TOKENS', 60)),
+        "seed": int(os.getenv('FAKE_LLM_SEED', 0)),
+    }
+
+
+def _fake(model_name, **options):
+    from .fake_chat_model import FakeChatModel
+    settings = fake_model_settings()
+    settings.update(options)
+    return FakeChatModel(model_name=model_name, **settings)
+
+
+register_provider("openai", _openai)
+register_provider("fake", _fake)
@@ -0,0 +1,122 @@
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+from .tokens import count_tokens
+
+# Table that remembers which migrations already ran on a database
+VERSION_TABLE = "schema_version"
+
+
+def _index_hot_queries(conn):
+    """
+    Index the history reads and the user/character lookups
+    """
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_chat_history_user_char_chat "
+        "ON chat_history (user_id, char_id, chat_id)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_chat_history_user_char_created "
+        "ON chat_history (user_id, char_id, created)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_characters_user_name "
+        "ON characters (user_id, char_name)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_characters_char_name "
+        "ON characters (char_name)"
+    ))
+
+
+def _add_token_counts(conn):
+    """
+    Store the token count of every message, so the context window
+    can be filled without tokenizing the history on every turn
+    """
+    if not _has_column(conn, "chat_history", "token_count"):
+        conn.execute(text("ALTER TABLE chat_history ADD COLUMN token_count INTEGER"))
+
+    last_chat_id = 0
+    while True:
+        rows = conn.execute(text(
+            "SELECT chat_id, message FROM chat_history "
+            "WHERE token_count IS NULL AND chat_id > :last ORDER BY chat_id LIMIT 1000"
+        ), {"last": last_chat_id}).all()
+
+        if not rows:
+            break
+
+        conn.execute(
+            text("UPDATE chat_history SET token_count = :count WHERE chat_id = :chat_id"),
+            [{"count": count_tokens(message), "chat_id": chat_id} for chat_id, message in rows]
+        )
+        last_chat_id = rows[-1][0]
+
+
+def _add_image_digest(conn):
+    """
+    Link characters to their portrait in the content-addressed image store
+    """
+    if not _has_column(conn, "characters", "image_digest"):
+        conn.execute(text("ALTER TABLE characters ADD COLUMN image_digest VARCHAR(64)"))
+
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_characters_image_digest ON characters (image_digest)"
+    ))
+
+
+# Ordered list of (version, description, migration)
+# A migration has to work on databases created by create_all() as well,
+# so it has to check what already exists instead of assuming an old schema.
+MIGRATIONS = [
+    (1, "Index chat_history and characters lookups", _index_hot_queries),
+    (2, "Add token_count to chat_history", _add_token_counts),
+    (3, "Add image_digest to characters", _add_image_digest),
+]
+
+
+def _has_column(conn, table, column):
+    return column in {col["name"] for col in inspect(conn).get_columns(table)}
+
+
+def get_schema_version(conn):
+    """
+    Get the newest migration that ran on the database, 0 if none ran
+    """
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} ("
+        "version INTEGER PRIMARY KEY, description VARCHAR(200) NOT NULL, applied DATETIME NOT NULL)"
+    ))
+    version = conn.execute(text(f"SELECT max(version) FROM {VERSION_TABLE}")).scalar()
+    return version or 0
+
+
+def upgrade(engine):
+    """
+    Run every migration the database has not seen yet, each in its own transaction.
+    Returns the versions that were applied.
+    """
+    applied = []
+
+    with engine.begin() as conn:
+        current = get_schema_version(conn)
+
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+
+        with engine.begin() as conn:
+            # Another worker could have migrated in the meantime
+            if get_schema_version(conn) >= version:
+                continue
+
+            migration(conn)
+            conn.execute(
+                text(f"INSERT INTO {VERSION_TABLE} (version, description, applied) VALUES (:v, :d, :a)"),
+                {"v": version, "d": description, "a": datetime.now()}
+            )
+        applied.append(version)
+
+    return applied
@@ -0,0 +1,238 @@
+import logging
+import queue
+import threading
+import time
+
+from .llm_providers import PROVIDERS, create_model
+
+from services.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MODEL_ATTEMPT_DURATION = REGISTRY.histogram(
+    "llm_model_attempt_seconds", "Duration of calls to a model by outcome", ("model", "outcome"))
+MODEL_FAILOVERS = REGISTRY.counter(
+    "llm_model_failovers_total", "Calls handed to the next model of a route", ("route", "model", "reason"))
+MODEL_LATENCY = REGISTRY.gauge(
+    "llm_model_latency_seconds", "Moving average of the successful call duration of a model", ("model",))
+
+# Weight of the newest call in the moving average latency of a model
+LATENCY_SMOOTHING = 0.2
+
+# Seconds a model is tried last after it failed or missed its budget
+FAILURE_COOLDOWN = 30
+
+_DONE = object()
+
+
+class ModelUnavailableError(Exception):
+    """
+    Raised if no model of a route answered within its latency budget
+    """
+
+
+def parse_routes(value):
+    """
+    Parse routes like 'action=gpt-4o-mini,gpt-4o;opening=gpt-4o,gpt-4o-mini'
+    into the ordered model names of every route
+    """
+    routes = {}
+    for entry in filter(None, (part.strip() for part in value.split(";"))):
+        route, _, names = entry.partition("=")
+        routes[route.strip()] = [name.strip() for name in names.split(",") if name.strip()]
+    return routes
+
+
+def parse_budgets(value):
+    """
+    Parse latency budgets in seconds like 'action=10,opening=30'
+    """
+    budgets = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        route, _, seconds = entry.partition("=")
+        budgets[route.strip()] = float(seconds)
+    return budgets
+
+
+def _create_model(spec):
+    # 'fake:fast' picks the provider, other names (also 'ft:gpt-4o-mini:...') use LLM_PROVIDER
+    provider, _, name = spec.partition(":")
+    if name and provider in PROVIDERS:
+        return create_model(name, provider)
+    return create_model(spec)
+
+
+class _ModelStats:
+    def __init__(self):
+        self.latency = None
+        self.failed_until = 0
+
+
+class ModelRouter:
+    """
+    Picks the model of a call by its route and fails over to the next model of the route.
+
+    Every route (e.g. action, turn, opening, summarize) has an ordered list of models
+    and a latency budget in seconds. A model that errors or does not finish within the
+    budget is abandoned and the next one is called. The router keeps a moving average of
+    the latency of every model; models that recently failed or are slower than the budget
+    are tried after the others, so routing follows the measured latency.
+    """
+
+    def __init__(self, routes, budgets=None, default_budget=30, models=None, factory=_create_model,
+                 cooldown=FAILURE_COOLDOWN):
+        self.routes = routes
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.cooldown = cooldown
+
+        self._factory = factory
+        self._models = dict(models or {})
+        self._stats = {}
+        self._lock = threading.Lock()
+
+
+    def invoke(self, prompt, route, on_token=None, on_reset=None):
+        """
+        Answer the prompt with the models of the route.
+        on_token is called with every token of the model that is answering, on_reset if
+        that model is abandoned after it sent tokens and the next one starts over.
+        """
+        if route not in self.routes:
+            raise ValueError(f"Unknown model route {route}, configured are: {', '.join(sorted(self.routes))}")
+
+        budget = self.budgets.get(route, self.default_budget)
+        error = None
+
+        for name in self.candidates(route):
+            start = time.perf_counter()
+            streamed = []
+            try:
+                response = self._attempt(name, prompt, budget, on_token, streamed)
+            except TimeoutError as e:
+                reason, error = "timeout", e
+            except Exception as e:
+                reason, error = "error", e
+                logger.warning("Model %s failed on route %s: %s", name, route, e)
+            else:
+                self._record(name, time.perf_counter() - start, "success")
+                return response
+
+            self._record(name, time.perf_counter() - start, reason)
+            MODEL_FAILOVERS.inc(route=route, model=name, reason=reason)
+            if streamed and on_reset:
+                on_reset()
+
+        raise ModelUnavailableError(
+            f"No model of route {route} answered within {budget} seconds, last error: {error}") from error
+
+
+    def candidates(self, route):
+        """
+        Models of the route in the order they are tried, healthy models first
+        """
+        budget = self.budgets.get(route, self.default_budget)
+        now = time.monotonic()
+
+        def degraded(name):
+            stats = self._stats.get(name)
+            if stats is None:
+                return False
+            return now < stats.failed_until or (stats.latency is not None and stats.latency > budget)
+
+        # Stable sort, the configured preference holds among healthy and among degraded models
+        return sorted(self.routes[route], key=degraded)
+
+
+    def latency(self, name):
+        """
+        Moving average of the successful calls of a model in seconds, None before the first one
+        """
+        stats = self._stats.get(name)
+        return None if stats is None else stats.latency
+
+
+    def model(self, name):
+        with self._lock:
+            if name not in self._models:
+                self._models[name] = self._factory(name)
+            return self._models[name]
+
+
+    def _attempt(self, name, prompt, budget, on_token, streamed):
+        """
+        Stream the answer of one model on its own thread and wait for it at most budget seconds.
+        A model that misses the budget is cancelled, its stream is closed at the next chunk
+        """
+        model = self.model(name)
+        chunks = queue.Queue()
+        cancelled = threading.Event()
+
+        def run():
+            stream = model.stream(prompt)
+            try:
+                for chunk in stream:
+                    if cancelled.is_set():
+                        break
+                    chunks.put(chunk)
+                chunks.put(_DONE)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                # Ends the request to the provider instead of reading the answer to the end
+                stream.close()
+
+        threading.Thread(target=run, name=f"model-{name}", daemon=True).start()
+        try:
+            return self._collect(name, chunks, budget, on_token, streamed)
+        finally:
+            cancelled.set()
+
+
+    def _collect(self, name, chunks, budget, on_token, streamed):
+        """
+        Merge the chunks of an attempt until it is done or the budget is over
+        """
+        deadline = time.monotonic() + budget
+        message = None
+        while True:
+            try:
+                item = chunks.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise TimeoutError(f"Model {name} did not answer within {budget} seconds") from None
+
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            message = item if message is None else message + item
+            if on_token and item.content:
+                streamed.append(item.content)
+                on_token(item.content)
+
+        if message is None:
+            raise ValueError(f"Model {name} returned no answer")
+
+        # Loaded with the first answer, importing the router does not load langchain
+        from langchain_core.messages import message_chunk_to_message
+        return message_chunk_to_message(message)
+
+
+    def _record(self, name, duration, outcome):
+        MODEL_ATTEMPT_DURATION.observe(duration, model=name, outcome=outcome)
+
+        with self._lock:
+            stats = self._stats.setdefault(name, _ModelStats())
+            if outcome == "success":
+                if stats.latency is None:
+                    stats.latency = duration
+                else:
+                    stats.latency += LATENCY_SMOOTHING * (duration - stats.latency)
+                latency = stats.latency
+            else:
+                stats.failed_until = time.monotonic() + self.cooldown
+                latency = None
+
+        if latency is not None:
+            MODEL_LATENCY.set(latency, model=name)
@@ -0,0 +1,63 @@
+import threading
+
+from sqlalchemy import event
+
+
+class QueryCounter:
+    """
+    Context manager that counts the SQL statements an engine executes, e.g.
+        with QueryCounter(db.engine) as counter:
+            client.get('/')
+        counter.count
+    Only statements of the thread that entered it are counted, not the ones
+    of background jobs or writer threads that run at the same time.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+        self.statements = []
+        self._thread_id = None
+
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() != self._thread_id:
+            return
+        self.count += 1
+        self.statements.append(statement)
+
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
+        return False
+
+
+class QueryCountGrowthError(AssertionError):
+    """
+    A route needs more queries for a bigger database, usually an N+1 query
+    """
+
+
+def assert_constant_queries(engine, run, seed, sizes):
+    """
+    Seed the database with each size in turn and count the queries of run().
+    Raises QueryCountGrowthError if the count changes with the size.
+    Returns a dict of size to query count.
+    """
+    counts = {}
+    for size in sizes:
+        seed(size)
+        with QueryCounter(engine) as counter:
+            run()
+        counts[size] = counter.count
+
+    if len(set(counts.values())) > 1:
+        raise QueryCountGrowthError(f"Query count grows with the data: {counts}")
+
+    return counts
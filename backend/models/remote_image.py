@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from sqlalchemy import String, DateTime
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .db import db
+
+class RemoteImage(db.Model):
+    """
+    Class for a remote image that is mirrored into the image store with:
+        the url it was fetched from (url)
+        the digest of the local copy (image_digest)
+        the ETag of the remote server for revalidation (etag)
+        the time it was last fetched or revalidated (fetched)
+    """
+    __tablename__ = "remote_images"
+
+    __table_args__ = {'extend_existing': True}
+
+    remote_id:Mapped[int] = mapped_column(primary_key = True)
+    url:Mapped[str] = mapped_column(String(500), nullable=False, unique=True)
+    image_digest:Mapped[str] = mapped_column(String(64), nullable=False)
+    etag:Mapped[str] = mapped_column(String(200), nullable=True)
+    fetched:Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
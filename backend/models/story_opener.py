@@ -0,0 +1,27 @@
+from datetime import datetime
+
+from sqlalchemy import String, Text, DateTime, Index
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .db import db
+
+class StoryOpener(db.Model):
+    """
+    Class for a ready-made opening scene with:
+        an unique identifier(opener_id)
+        the language it is written in
+        an optional character archetype it fits (archetype)
+        the opening scene itself (message)
+    """
+    __tablename__ = "story_openers"
+
+    __table_args__ = (
+        Index('ix_story_openers_language_archetype', 'language', 'archetype', 'opener_id'),
+        {'extend_existing': True}
+    )
+
+    opener_id:Mapped[int] = mapped_column(primary_key = True)
+    language:Mapped[str] = mapped_column(String(50), nullable=False)
+    archetype:Mapped[str] = mapped_column(String(50), nullable=True)
+    message:Mapped[str] = mapped_column(Text, nullable=False)
+    created:Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
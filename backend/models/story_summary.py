@@ -0,0 +1,30 @@
+from datetime import datetime
+
+from sqlalchemy import ForeignKey, Text, DateTime, Integer, UniqueConstraint
+from sqlalchemy.orm import relationship, Mapped, mapped_column
+
+from .db import db
+
+class StorySummary(db.Model):
+    """
+    Class for the running summary of a chat with:
+        the chat partners (user_id, char_id)
+        the summary of the story (summary)
+        the newest message that is part of the summary (summarized_through)
+    """
+    __tablename__ = "story_summaries"
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'char_id', name='uq_story_summaries_user_char'),
+        {'extend_existing': True}
+    )
+
+    summary_id:Mapped[int] = mapped_column(primary_key = True)
+    summary:Mapped[str] = mapped_column(Text, nullable=False)
+    summarized_through:Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    token_count:Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    updated:Mapped[datetime] = mapped_column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    user_id:Mapped[int] = mapped_column(ForeignKey("users.user_id"))
+    char_id:Mapped[int] = mapped_column(ForeignKey("characters.char_id"))
+    through_char:Mapped["Character"] = relationship(back_populates="story_summaries")
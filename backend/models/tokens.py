@@ -0,0 +1,51 @@
+from functools import lru_cache
+
+# Tokens OpenAI adds around every message of a chat prompt
+MESSAGE_OVERHEAD = 3
+
+# Encoding of the gpt-4o model family
+ENCODING_NAME = "o200k_base"
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    """
+    Load the tiktoken encoding once, None if it cannot be loaded (e.g. offline)
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception:
+        return None
+
+
+def count_tokens(text):
+    """
+    Count the tokens a message costs in a prompt.
+    Falls back to an estimate of 4 characters per token without tiktoken.
+    """
+    text = text or ""
+    encoding = _encoding()
+
+    if encoding is None:
+        return len(text) // 4 + 1 + MESSAGE_OVERHEAD
+
+    return len(encoding.encode(text)) + MESSAGE_OVERHEAD
+
+
+def count_message_tokens(messages):
+    """
+    Token counter for langchain messages, uses the count stored with a message if there is one
+    """
+    total = 0
+    for message in messages:
+        stored = message.additional_kwargs.get("token_count")
+        total += stored if stored is not None else count_tokens(str(message.content))
+    return total
+
+
+def default_token_count(context):
+    """
+    Column default to count the tokens of a ChatHistory message when the row is written
+    """
+    return count_tokens(context.get_current_parameters()["message"])
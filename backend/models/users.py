@@ -19,8 +19,9 @@ class User(db.Model):
     user_id:Mapped[int] = mapped_column(primary_key = True)
     username:Mapped[str] = mapped_column(String(30), nullable = False, unique = True)
 
-    created_chars:Mapped[List["Character"]] = relationship(back_populates="creator",
-                                                           lazy= "dynamic", cascade= "all, delete-orphan")
+    # Loaded for all users of a query at once, so lists of users need no query per user
+    created_chars:Mapped[List["Character"]] = relationship(back_populates="creator", order_by="Character.char_name",
+                                                           lazy= "selectin", cascade= "all, delete-orphan")
     chats:Mapped["ChatHistory"] = relationship(back_populates="chatted_with",
                                                lazy="select", cascade="all, delete-orphan")
     def __str__(self):
@@ -0,0 +1,8 @@
+from .job_queue import JobQueue
+from .metrics import REGISTRY, init_metrics
+from .logging_setup import configure_logging
+from .image_store import ImageStore, InvalidImageError
+from .image_fetcher import ImageFetcher, RemoteImageError
+from .process_local import ProcessLocal
+from .turn_scheduler import TurnScheduler
+from .admission import AdmissionController, AdmissionRejected
@@ -0,0 +1,181 @@
+import threading
+import time
+
+from .metrics import REGISTRY
+
+ADMISSION_DECISIONS = REGISTRY.counter(
+    "admission_decisions_total", "Chat and opening requests admitted or rejected", ("result", "reason"))
+MODEL_CALLS_IN_FLIGHT = REGISTRY.gauge(
+    "admission_in_flight", "Admitted requests that may call the model and are not finished")
+ADMISSION_LIMITS = REGISTRY.gauge(
+    "admission_limit", "Configured admission limits, 0 is unlimited", ("limit",))
+
+# Number of user buckets after which the full, idle ones are dropped
+MAX_TRACKED_USERS = 10000
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised if a request is not admitted, retry_after is the number of seconds to wait
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Too many requests ({reason}), retry in {retry_after:.1f} seconds")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Bucket of burst tokens that refills with rate tokens per second
+    """
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    def wait_time(self):
+        """
+        Seconds until a token is available, 0 if there is one
+        """
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Admission:
+    """
+    An admitted request, counted as in flight until it is released
+    """
+
+    def __init__(self, controller):
+        self._controller = controller
+        self._released = False
+
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class AdmissionController:
+    """
+    Admission control in front of everything that calls the model.
+    A request needs a token of its user's bucket, a token of the global bucket
+    and a free in-flight slot. Otherwise it is rejected at once with the time
+    after which a retry can succeed, instead of waiting in a queue.
+    A rate or limit of 0 switches the check off.
+    """
+
+    def __init__(self, user_rate=0.5, user_burst=5, global_rate=10, global_burst=20,
+                 max_in_flight=32, in_flight_retry_after=1):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.max_in_flight = max_in_flight
+        self.in_flight_retry_after = in_flight_retry_after
+
+        self._users = {}
+        self._global = TokenBucket(global_rate, global_burst) if global_rate else None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+        for name in ("user_rate", "user_burst", "global_rate", "global_burst", "max_in_flight"):
+            ADMISSION_LIMITS.set(getattr(self, name), limit=name)
+
+
+    def admit(self, user_id):
+        """
+        Admit a request of a user or raise AdmissionRejected.
+        Returns an Admission that has to be released once the request is done
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                raise self._reject("in_flight", self.in_flight_retry_after)
+
+            buckets = []
+            if self.user_rate:
+                buckets.append(("user_rate", self._user_bucket(user_id, now)))
+            if self._global is not None:
+                buckets.append(("global_rate", self._global))
+
+            # Check all buckets before taking a token, a rejected request costs nothing
+            for reason, bucket in buckets:
+                bucket.refill(now)
+                wait = bucket.wait_time()
+                if wait:
+                    raise self._reject(reason, wait)
+
+            for _, bucket in buckets:
+                bucket.tokens -= 1
+
+            self._in_flight += 1
+
+        MODEL_CALLS_IN_FLIGHT.inc()
+        ADMISSION_DECISIONS.inc(result="admitted", reason="")
+        return Admission(self)
+
+
+    def admit_background(self):
+        """
+        Admit background work that calls the model, e.g. filling a pool, or raise AdmissionRejected.
+        It only needs a free in-flight slot, the rate buckets are left to the users
+        """
+        with self._lock:
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                raise self._reject("in_flight", self.in_flight_retry_after)
+            self._in_flight += 1
+
+        MODEL_CALLS_IN_FLIGHT.inc()
+        ADMISSION_DECISIONS.inc(result="admitted", reason="background")
+        return Admission(self)
+
+
+    def _user_bucket(self, user_id, now):
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            if len(self._users) >= MAX_TRACKED_USERS:
+                self._prune(now)
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst, now)
+        return bucket
+
+
+    def _prune(self, now):
+        """
+        Forget the buckets that refilled completely, they equal a new bucket
+        """
+        for user_id, bucket in list(self._users.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._users[user_id]
+
+
+    def _reject(self, reason, retry_after):
+        ADMISSION_DECISIONS.inc(result="rejected", reason=reason)
+        return AdmissionRejected(reason, retry_after)
+
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        MODEL_CALLS_IN_FLIGHT.dec()
@@ -0,0 +1,130 @@
+import ipaddress
+import socket
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .image_store import InvalidImageError
+
+# Largest remote image that is mirrored
+MAX_REMOTE_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Connect and read timeout in seconds
+FETCH_TIMEOUT = (3.05, 10)
+
+# Redirects followed per image, every hop is checked like the first url
+MAX_REDIRECTS = 3
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class RemoteImageError(Exception):
+    """
+    A remote image could not be fetched or is no image
+    """
+
+
+class ImageFetcher:
+    """
+    Fetches remote images into the image store over one pooled HTTP session,
+    meant to run in a background job instead of a request.
+    Urls are user input: only hosts that resolve to public addresses are fetched,
+    and redirects are followed by hand so every hop is checked as well.
+    """
+
+    def __init__(self, image_store, max_bytes=MAX_REMOTE_IMAGE_BYTES, timeout=FETCH_TIMEOUT, pool_size=10,
+                 allow_private=False):
+        self.image_store = image_store
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.allow_private = allow_private
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["User-Agent"] = "StoryAI image mirror"
+
+
+    def fetch(self, url, etag=None):
+        """
+        Mirror an image into the store.
+        Returns (digest, etag), or None if the server answered that the image with this etag is unchanged.
+        """
+        headers = {"If-None-Match": etag} if etag else {}
+
+        try:
+            with self._get(url, headers) as response:
+                if response.status_code == 304:
+                    return None
+
+                if response.status_code != 200:
+                    raise RemoteImageError(f"Image URL answered with status {response.status_code}")
+
+                if 'image' not in response.headers.get('Content-Type', ''):
+                    raise RemoteImageError("Invalid image URL or unsupported type")
+
+                if int(response.headers.get('Content-Length') or 0) > self.max_bytes:
+                    raise RemoteImageError("Image is too large")
+
+                data = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    data.extend(chunk)
+                    if len(data) > self.max_bytes:
+                        raise RemoteImageError("Image is too large")
+
+                new_etag = response.headers.get('ETag')
+
+        except requests.exceptions.RequestException as e:
+            raise RemoteImageError(f"Could not reach provided image URL: {e}") from e
+
+        try:
+            digest = self.image_store.add(bytes(data))
+        except InvalidImageError as e:
+            raise RemoteImageError(str(e)) from e
+
+        return digest, new_etag
+
+
+    def _get(self, url, headers):
+        """
+        GET a url and follow up to MAX_REDIRECTS redirects, each target is checked before it is requested
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            self._check_url(url)
+            response = self.session.get(url, headers=headers, timeout=self.timeout, stream=True,
+                                        allow_redirects=False)
+
+            location = response.headers.get('Location')
+            if response.status_code not in REDIRECT_STATUSES or not location:
+                return response
+
+            response.close()
+            url = urljoin(url, location)
+
+        raise RemoteImageError("Image URL redirects too often")
+
+
+    def _check_url(self, url):
+        """
+        Reject urls that are not http(s) or whose host resolves to a loopback, private,
+        link-local or otherwise non-public address
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise RemoteImageError("Image URL must be an http or https URL")
+
+        if self.allow_private:
+            return
+
+        try:
+            addresses = {info[4][0] for info in
+                         socket.getaddrinfo(parts.hostname, parts.port, type=socket.SOCK_STREAM)}
+        except (socket.gaierror, UnicodeError) as e:
+            raise RemoteImageError(f"Could not resolve image host {parts.hostname}") from e
+
+        for address in addresses:
+            # Scope ids of IPv6 link-local addresses are not part of the address
+            if not ipaddress.ip_address(address.split("%")[0]).is_global:
+                raise RemoteImageError("Image URL points to a non-public address")
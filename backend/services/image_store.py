@@ -0,0 +1,144 @@
+import contextlib
+import fcntl
+import hashlib
+import io
+import os
+
+from PIL import Image, UnidentifiedImageError
+
+# Longest side of a thumbnail in pixels, roster pages show portraits at 80px
+THUMBNAIL_SIZE = 160
+
+# Formats accepted as uploads and the extension their original is stored with
+ALLOWED_FORMATS = {"JPEG": ".jpg", "PNG": ".png", "GIF": ".gif", "WEBP": ".webp"}
+
+# Variants served for every image
+VARIANTS = ("original", "webp", "thumb")
+
+
+class InvalidImageError(ValueError):
+    """
+    The uploaded file is no image in one of the ALLOWED_FORMATS
+    """
+
+
+class ImageStore:
+    """
+    Content-addressed store for character portraits.
+    Every image is saved under the sha256 of its bytes, so identical uploads are stored once.
+    A full-size WebP and a WebP thumbnail are generated when an image is added.
+    Files never change once written, so they can be cached forever.
+    Adding an image and referencing it must happen under lock(), like checking the
+    references and deleting it, else a delete can remove an image that was just referenced again.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        Lock the store against the other threads and worker processes
+        """
+        with open(os.path.join(self.root, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+    def add(self, data):
+        """
+        Store the bytes of an image and its variants, return its digest
+        """
+        digest = hashlib.sha256(data).hexdigest()
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            image_format = image.format
+            image.load()
+        except (UnidentifiedImageError, OSError) as e:
+            raise InvalidImageError("The file is no valid image") from e
+        except Image.DecompressionBombError as e:
+            raise InvalidImageError("The image has too many pixels") from e
+
+        if image_format not in ALLOWED_FORMATS:
+            raise InvalidImageError(f"Unsupported image format {image_format}")
+
+        directory = self._directory(digest)
+        if os.path.exists(os.path.join(directory, "thumb.webp")):
+            # Already stored, nothing to do
+            return digest
+
+        os.makedirs(directory, exist_ok=True)
+        self._write(os.path.join(directory, f"original{ALLOWED_FORMATS[image_format]}"), data)
+
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+
+        buffer = io.BytesIO()
+        image.save(buffer, "WEBP", quality=85)
+        self._write(os.path.join(directory, "webp.webp"), buffer.getvalue())
+
+        thumbnail = image.copy()
+        thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, "WEBP", quality=80)
+        # The thumbnail is written last, it marks a complete entry
+        self._write(os.path.join(directory, "thumb.webp"), buffer.getvalue())
+
+        return digest
+
+
+    def path(self, digest, variant):
+        """
+        Get the file of a variant, None if it does not exist
+        """
+        if variant not in VARIANTS or not self._is_digest(digest):
+            return None
+
+        directory = self._directory(digest)
+        if not os.path.isdir(directory):
+            return None
+
+        for filename in os.listdir(directory):
+            if os.path.splitext(filename)[0] == variant:
+                return os.path.join(directory, filename)
+        return None
+
+
+    def delete(self, digest):
+        """
+        Remove an image and all its variants
+        """
+        if not self._is_digest(digest):
+            return
+
+        directory = self._directory(digest)
+        if not os.path.isdir(directory):
+            return
+
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+        os.rmdir(directory)
+
+
+    def _directory(self, digest):
+        # Two levels of fan-out keep directories small
+        return os.path.join(self.root, digest[:2], digest)
+
+
+    @staticmethod
+    def _is_digest(digest):
+        return len(digest) == 64 and all(c in "0123456789abcdef" for c in digest)
+
+
+    @staticmethod
+    def _write(path, data):
+        """
+        Write through a temporary file, so readers never see half an image
+        """
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
@@ -0,0 +1,243 @@
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# How long finished jobs stay available for polling (seconds)
+JOB_RESULT_TTL = 600
+
+# Seconds between deleting expired jobs from the store
+JOB_STORE_PRUNE_INTERVAL = 60
+
+JOBS_QUEUED = REGISTRY.gauge("jobs_queued", "Jobs submitted to the job queue that have not started yet")
+
+
+class Job:
+    """
+    Class for a job with:
+        an unique identifier(job_id)
+        a status: queued, running, done or failed
+        the result or error once it finished
+        an optional key to find unfinished jobs for the same work
+        an optional order_key, jobs with the same order_key run one after the other
+    """
+
+    def __init__(self, func, args, kwargs, key=None, order_key=None):
+        self.job_id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.key = key
+        self.order_key = order_key
+
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    Local work queue with a pool of worker threads.
+    The number of concurrent LLM calls is bounded separately from the worker count.
+    With a store (e.g. data.JobManager) the state of every job is also saved there,
+    so a job can be polled from every worker process, not only the one running it.
+    """
+
+    def __init__(self, app, workers=4, max_llm_calls=4, store=None):
+        self.app = app
+        self.workers = workers
+        self.max_llm_calls = max_llm_calls
+        self.store = store
+
+        self._reset()
+
+        # A forked worker starts with an empty queue and its own threads and locks
+        os.register_at_fork(after_in_child=self._reset)
+
+
+    def _reset(self):
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        # Jobs held back until the running job of their order_key is done
+        self._ordered = {}
+        self._llm_slots = threading.BoundedSemaphore(self.max_llm_calls)
+        self._store_pruned = 0
+
+
+    def submit(self, func, *args, key=None, order_key=None, on_duplicate=None, **kwargs):
+        """
+        Enqueue a function call and return its job_id.
+        If an unfinished job with the same key exists, its job_id is returned instead
+        and on_duplicate is called, e.g. to free what was reserved for the call.
+        Jobs with the same order_key run in the order they were submitted and never
+        at the same time, so they do not occupy several workers while waiting for each other.
+        """
+        with self._lock:
+            self._prune()
+
+            duplicate = self._keys.get(key) if key is not None else None
+
+            if duplicate is None:
+                job = Job(func, args, kwargs, key=key, order_key=order_key)
+                self._jobs[job.job_id] = job
+                if key is not None:
+                    self._keys[key] = job.job_id
+
+                held = False
+                if order_key is not None:
+                    if order_key in self._ordered:
+                        self._ordered[order_key].append(job)
+                        held = True
+                    else:
+                        self._ordered[order_key] = deque()
+
+        if duplicate is not None:
+            if on_duplicate is not None:
+                on_duplicate()
+            return duplicate
+
+        self._save(job)
+        self._prune_store()
+
+        JOBS_QUEUED.inc()
+        self._start_workers()
+        if not held:
+            self._queue.put(job)
+        return job.job_id
+
+
+    def get(self, job_id):
+        """
+        Get the state of a job as a dict, None if the job is unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.to_dict()
+
+        # Queued on another worker process
+        return self.store.get(job_id) if self.store is not None else None
+
+
+    @contextmanager
+    def llm_slot(self):
+        """
+        Wait for a free slot to call the model
+        """
+        with self._llm_slots:
+            yield
+
+
+    def _start_workers(self):
+        """
+        Start the worker threads on first use, so they are created in the serving process
+        """
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name="job-worker", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            JOBS_QUEUED.dec()
+            job.status = "running"
+
+            try:
+                with self.app.app_context():
+                    self._save(job)
+                    try:
+                        job.result = job.func(*job.args, **job.kwargs)
+                        job.status = "done"
+                    except Exception as e:
+                        logger.exception("Job %s failed", job.job_id)
+                        job.error = str(e)
+                        job.status = "failed"
+                    job.finished = time.time()
+                    self._save(job)
+            finally:
+                job.finished = job.finished or time.time()
+                with self._lock:
+                    if job.key is not None:
+                        self._keys.pop(job.key, None)
+                    next_job = self._release(job.order_key)
+                if next_job is not None:
+                    self._queue.put(next_job)
+                self._queue.task_done()
+
+
+    def _release(self, order_key):
+        """
+        The next held job of an order_key, None if there is none
+        """
+        if order_key is None:
+            return None
+
+        held = self._ordered[order_key]
+        if held:
+            return held.popleft()
+
+        del self._ordered[order_key]
+        return None
+
+
+    def _save(self, job):
+        """
+        Save the state of a job in the store, a failing store only costs the polls of other processes
+        """
+        if self.store is None:
+            return
+        try:
+            self.store.save(job)
+        except Exception:
+            logger.exception("Saving the state of job %s failed", job.job_id)
+
+
+    def _prune_store(self):
+        """
+        Delete the jobs that finished more than JOB_RESULT_TTL seconds ago from the store,
+        at most once per JOB_STORE_PRUNE_INTERVAL
+        """
+        now = time.time()
+        if self.store is None or now - self._store_pruned < JOB_STORE_PRUNE_INTERVAL:
+            return
+        self._store_pruned = now
+        try:
+            self.store.prune(now - JOB_RESULT_TTL)
+        except Exception:
+            logger.exception("Pruning finished jobs failed")
+
+
+    def _prune(self):
+        """
+        Forget finished jobs after JOB_RESULT_TTL seconds
+        """
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished and now - job.finished > JOB_RESULT_TTL]
+        for job_id in expired:
+            del self._jobs[job_id]
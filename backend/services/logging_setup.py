@@ -0,0 +1,125 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Headers whose values never end up in a log
+SENSITIVE_HEADERS = {"authorization", "cookie", "set-cookie", "proxy-authorization", "x-api-key"}
+
+# Characters of a request body that are logged at most
+MAX_LOGGED_BODY = 200
+
+_listener = None
+
+
+class DebugSamplingFilter(logging.Filter):
+    """
+    Let only a share of the DEBUG records through, all other levels pass
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+def redact_headers(headers):
+    """
+    Copy of the headers with the values of sensitive headers replaced
+    """
+    return {name: "[redacted]" if name.lower() in SENSITIVE_HEADERS else value
+            for name, value in headers.items()}
+
+
+def redact_body(body):
+    """
+    Replace a request body by its size for a log.
+    With LOG_REQUEST_BODIES=1 the first MAX_LOGGED_BODY characters are kept, for local debugging only
+    """
+    if os.getenv('LOG_REQUEST_BODIES', '').lower() not in ('1', 'true'):
+        return f"[redacted {len(body)} bytes]"
+
+    if isinstance(body, bytes):
+        body = body[:MAX_LOGGED_BODY + 1].decode("utf-8", errors="replace")
+    return body[:MAX_LOGGED_BODY] + ("..." if len(body) > MAX_LOGGED_BODY else "")
+
+
+def _parse_levels(value):
+    """
+    Parse per-module levels like 'backend_app=DEBUG,services.job_queue=WARNING'
+    """
+    levels = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        name, _, level = entry.partition("=")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def _restart_listener():
+    """
+    Start a listener on a new queue in a forked worker. The queue of the parent
+    still has the waiter of the parent's listener thread, which does not exist here.
+    """
+    global _listener
+
+    if _listener is None:
+        return
+
+    log_queue = queue.Queue(-1)
+    _listener = QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, QueueHandler):
+            handler.queue = log_queue
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def configure_logging(debug=False):
+    """
+    Log through a queue, so request threads never block on writing to stdout.
+    Configure with:
+        LOG_LEVEL: level of the root logger, DEBUG in debug mode else INFO
+        LOG_LEVELS: per-module levels, e.g. 'backend_app=DEBUG,werkzeug=WARNING'
+        LOG_DEBUG_SAMPLE_RATE: share of DEBUG records that are written, between 0 and 1
+    """
+    global _listener
+
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue(-1)
+    _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_stop_listener)
+
+    # The listener thread does not survive a fork, forked workers start their own
+    os.register_at_fork(after_in_child=_restart_listener)
+
+    # Sampled before a record is formatted and queued, so a dropped record costs the request thread nothing more
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(DebugSamplingFilter(float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 1.0))))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(os.getenv('LOG_LEVEL', "DEBUG" if debug else "INFO").upper())
+
+    for name, level in _parse_levels(os.getenv('LOG_LEVELS', '')).items():
+        logging.getLogger(name).setLevel(level)
@@ -0,0 +1,44 @@
+import os
+import threading
+
+
+class ProcessLocal:
+    """
+    A resource that is created on first use and belongs to one process.
+    A worker forked from a process that already created it creates its own,
+    instead of sharing connections, threads or file handles with its parent.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+        # A lock held by another thread at fork time would never be released in the child
+        os.register_at_fork(after_in_child=self._after_fork)
+
+
+    def get(self):
+        """
+        Get the resource of this process, create it if there is none yet
+        """
+        current = self._value
+        if current is not None and current[0] == os.getpid():
+            return current[1]
+
+        with self._lock:
+            if self._value is None or self._value[0] != os.getpid():
+                self._value = (os.getpid(), self.factory())
+            return self._value[1]
+
+
+    def set(self, value):
+        """
+        Use a ready-made resource in this process, e.g. a fake in benchmarks
+        """
+        with self._lock:
+            self._value = (os.getpid(), value)
+
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
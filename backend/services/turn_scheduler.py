@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from .metrics import REGISTRY
+
+TURNS_WAITING = REGISTRY.gauge(
+    "chat_turns_waiting", "Chat turns waiting for an earlier turn of their conversation")
+CONVERSATIONS_ACTIVE = REGISTRY.gauge(
+    "chat_conversations_active", "Conversations with a running turn")
+TURN_QUEUE_DEPTH = REGISTRY.histogram(
+    "chat_turn_queue_depth", "Turns ahead of a new turn in its conversation",
+    buckets=(0, 1, 2, 3, 5, 10, 20))
+TURN_WAIT_DURATION = REGISTRY.histogram(
+    "chat_turn_wait_seconds", "Time a turn waited for the earlier turns of its conversation")
+
+
+class _Conversation:
+    def __init__(self):
+        self.waiters = deque()
+
+
+class TurnScheduler:
+    """
+    Runs the turns of one conversation one after the other, in the order they arrived,
+    while turns of different conversations run in parallel on their own threads.
+    A conversation only exists while it has a running or waiting turn.
+    """
+
+    def __init__(self):
+        self._conversations = {}
+        self._lock = threading.Lock()
+
+
+    @contextmanager
+    def turn(self, key):
+        """
+        Wait until all earlier turns of the conversation key are done, then run the block
+        """
+        start = time.perf_counter()
+
+        with self._lock:
+            conversation = self._conversations.get(key)
+            if conversation is None:
+                conversation = self._conversations[key] = _Conversation()
+                CONVERSATIONS_ACTIVE.inc()
+                ready = None
+                TURN_QUEUE_DEPTH.observe(0)
+            else:
+                ready = threading.Event()
+                conversation.waiters.append(ready)
+                TURNS_WAITING.inc()
+                # The running turn and everyone queued before this one
+                TURN_QUEUE_DEPTH.observe(len(conversation.waiters))
+
+        if ready is not None:
+            # The finishing turn hands the conversation over to the next one
+            ready.wait()
+            TURNS_WAITING.dec()
+
+        TURN_WAIT_DURATION.observe(time.perf_counter() - start)
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                if conversation.waiters:
+                    conversation.waiters.popleft().set()
+                else:
+                    del self._conversations[key]
+                    CONVERSATIONS_ACTIVE.dec()
+
+
+    def queue_depth(self, key):
+        """
+        Number of running and waiting turns of a conversation
+        """
+        with self._lock:
+            conversation = self._conversations.get(key)
+            return 0 if conversation is None else len(conversation.waiters) + 1
@@ -1,5 +1,6 @@
 import streamlit as st
-import requests
+
+from backend_client import BackendClient, BackendError
 
 st.set_page_config(
     page_icon= "📓",
@@ -8,7 +9,13 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-BACKEND_URL = "http://localhost:5000"
+
+@st.cache_resource
+def get_backend_client():
+    """
+    One client with a pool of keep-alive connections, shared by all sessions
+    """
+    return BackendClient()
 
 
 username_param = st.query_params.get('username', None)
@@ -16,28 +23,55 @@ char_name_param = st.query_params.get('char_name', None)
 embed_mode = username_param is not None and char_name_param is not None
 
 
-def fetch_history(username, char_name):
-    response = requests.get(f"{BACKEND_URL}/users/{username}/characters/{char_name}/history")
-
-    if response.status_code == 200:
-        data = response.json()
-        return data
-    else:
-        print(f"Error fetching history: {response.status_code}")
-        print(f"Error message: {response.text}")
+def fetch_history(username, char_name, after=None):
+    """
+    Fetch the chat history, or only the messages newer than the chat_id after
+    """
+    try:
+        page = get_backend_client().fetch_history(username, char_name, after=after,
+                                                  etag=st.session_state.get('history_etag'))
+    except BackendError as e:
+        print(f"Error fetching history: {e}")
         return []
 
+    st.session_state.history_etag = page.etag
+    return page.messages
 
-def send_message(username, char_name, message):
+
+def last_chat_id():
+    """
+    The chat_id of the newest message the client already has
+    """
+    if st.session_state.chat_history:
+        return st.session_state.chat_history[-1].get('chat_id')
+    return None
+
+
+def stream_message(username, char_name, message):
+    """
+    Send a message and yield the AI reply so far every time the backend streams a token.
+    If the backend starts the reply over with another model (reset), the reply starts empty again.
+    The saved messages of the turn are kept in st.session_state.new_messages
+    """
+    reply = ""
     try:
-        response = requests.post(
-            f"{BACKEND_URL}/users/{username}/characters/{char_name}/chat",
-            json={"message":message}
-        )
-        return response.status_code == 200
-    except requests.exceptions.ConnectionError:
-        st.error("Connection to Flask Backend failed.")
-        return False
+        for event, payload in get_backend_client().stream_message(username, char_name, message):
+            if event == "error":
+                st.session_state.stream_failed = True
+                return
+            if event == "done":
+                st.session_state.new_messages = payload.get("messages", [])
+            if event == "reset":
+                reply = ""
+                yield reply
+            if "token" in payload:
+                reply += payload["token"]
+                yield reply
+
+    except BackendError as e:
+        st.error(str(e))
+        st.session_state.stream_failed = True
+
 
 def main():
     if embed_mode and username_param and char_name_param:
@@ -85,8 +119,21 @@ def main():
 
         # Handle send
         if submitted and user_input.strip():
-            if send_message(username_param, char_name_param, user_input):
-                st.session_state.chat_history = fetch_history(username_param, char_name_param)
+            with st.chat_message('user'):
+                st.write(user_input)
+
+            st.session_state.stream_failed = False
+            st.session_state.new_messages = []
+            with st.chat_message('assistant'):
+                # Not st.write_stream, a reset has to replace the text written so far
+                reply_placeholder = st.empty()
+                for reply in stream_message(username_param, char_name_param, user_input):
+                    reply_placeholder.write(reply)
+
+            if not st.session_state.stream_failed:
+                # The backend answered with the saved turn, only fetch if it did not
+                st.session_state.chat_history += st.session_state.new_messages or \
+                    fetch_history(username_param, char_name_param, after=last_chat_id())
                 st.session_state.chat_loaded = True
                 st.rerun()
             else:
@@ -0,0 +1,9 @@
+"""
+Fails if a page or chat route needs more queries for more users or characters, see benchmarks/query_guard.py
+"""
+from benchmarks.query_guard import check_routes
+
+
+def test_routes_need_constant_queries():
+    failures = {name: str(error) for name, (_, error) in check_routes().items() if error is not None}
+    assert not failures